@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Copyright © 2014, W. van Ham, Radboud University Nijmegen
+This file is part of Sleelab.
+
+Sleelab is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Sleelab is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Sleelab.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Headless benchmark of the ball physics, no display needed.
+# Steps nBalls balls for nFrame frames for every moveType and dimType and
+# reports the time per ball-step and the memory allocated per step.
+#   python benchmark.py -n 300 -m 1000 -r 0.01 --ballCollide
+
+from __future__ import print_function
+import argparse, timeit, numpy as np
+import physics
+try:
+	import tracemalloc # python 3.4 and up
+except ImportError:
+	tracemalloc = None
+
+def allocatedPerStep(engine, nStep):
+	"""
+	Mean number of bytes of temporary memory (peak above baseline) per step,
+	None if unavailable. nStep should be a multiple of the noise block
+	length of the virtual spring, so that the mean includes the refills of
+	the noise block in the same proportion however long the benchmark runs.
+	"""
+	if tracemalloc is None or not hasattr(tracemalloc, "reset_peak"):
+		return None
+	tracemalloc.start()
+	total = 0
+	for iStep in range(nStep):
+		current = tracemalloc.get_traced_memory()[0]
+		tracemalloc.reset_peak()
+		engine.step()
+		total += tracemalloc.get_traced_memory()[1] - current
+	tracemalloc.stop()
+	return float(total)/nStep
+
+def benchmark(moveType, dimType, nBalls, nFrame, rBalls=.04, ballCollide=False, seed=0):
+	"""Return (ns per ball-step, bytes allocated per step)."""
+	engine = physics.Engine(moveType, dimType, rBalls, ballCollide=ballCollide, rng=np.random.RandomState(seed))
+	engine.initialize(nBalls, 0.5)
+	engine.step() # warm up
+	clock = timeit.default_timer
+	t0 = clock()
+	for iFrame in range(nFrame):
+		engine.step()
+	ns = (clock()-t0)/nFrame/nBalls*1e9
+	return ns, allocatedPerStep(engine, engine.spring.nBlock) # amortized over one noise block
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the ball physics without Qt or OpenGL.")
+	parser.add_argument("-n", "--nBalls", type=int, default=50, help="number of balls")
+	parser.add_argument("-m", "--nFrame", type=int, default=1000, help="number of frames")
+	parser.add_argument("-r", "--rBalls", type=float, default=.04, help="radius of the balls (m)")
+	parser.add_argument("--moveType", action="append", help="ConstantVelocity or virtualSpring, default both")
+	parser.add_argument("--dimType", action="append", help="2D or 3D, default both")
+	parser.add_argument("--ballCollide", action="store_true", help="enable ball-ball collisions")
+	args = parser.parse_args()
+
+	print("{:18s} {:7s} {:>7s} {:>14s} {:>14s}".format("moveType", "dimType", "nBalls", "ns/ball-step", "B alloc/step"))
+	for moveType in args.moveType or ["ConstantVelocity", "virtualSpring"]:
+		for dimType in args.dimType or ["2D", "3D"]:
+			try:
+				ns, allocated = benchmark(moveType, dimType, args.nBalls, args.nFrame, args.rBalls, args.ballCollide)
+			except ValueError: # placeBalls
+				print("{:18s} {:7s} {:7d} {:>14s}".format(moveType, dimType, args.nBalls, "does not fit"))
+				continue
+			print("{:18s} {:7s} {:7d} {:14.1f} {:>14s}".format(moveType, dimType, args.nBalls, ns,
+				"n/a" if allocated is None else "{:.0f}".format(allocated)))
+
+if __name__ == '__main__':
+	main()
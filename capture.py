@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Copyright © 2014, W. van Ham, Radboud University Nijmegen
+This file is part of Sleelab.
+
+Sleelab is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Sleelab is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Sleelab.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Capture of the displayed frames to disk without stalling the frame loop.
+# glReadPixels into a pixel buffer object returns immediately, the copy is
+# done by the video card. A fence tells when it is done, a few frames later
+# the buffer is mapped and copied into a preallocated frame, and a worker
+# thread encodes and writes it. If the worker falls behind, frames are
+# dropped (and counted) instead of making the frame loop wait.
+# Output in directory:
+#   frames.csv         one line per written frame: index, nFrame, time (s), state
+#   frame000000.png    with format "png", top row first, RGB
+#   frames.raw         with format "raw", all frames as read, bottom row first, BGRA
+
+from __future__ import print_function
+import os, ctypes, struct, zlib, threading, logging, numpy as np
+try:
+	import queue # python 3
+except ImportError:
+	import Queue as queue
+
+from OpenGL.GL import *
+
+def writePng(fileName, rgb, level=1):
+	"""Write rgb, (height, width, 3) uint8, as a png file. Low compression levels are much faster."""
+	height, width = rgb.shape[:2]
+	rows = np.zeros((height, 1+3*width), dtype=np.uint8) # filter type 0 in front of every row
+	rows[:,1:] = rgb.reshape(height, -1)
+	def chunk(kind, data):
+		return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+	with open(fileName, 'wb') as f:
+		f.write(b'\x89PNG\r\n\x1a\n')
+		f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+		f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), level)))
+		f.write(chunk(b'IEND', b''))
+
+class FrameCapture(object):
+	"""
+	Call capture() after drawing a frame and before swapping the buffers, and
+	close() at the end, all with the OpenGL context current. nBuffer pixel
+	buffer objects are in flight, nQueue frames can wait for the writer.
+	"""
+	formats = ("png", "raw")
+
+	def __init__(self, directory, width, height, format="png", nBuffer=3, nQueue=16):
+		if format not in self.formats:
+			raise ValueError("capture format not recognized: {}".format(format))
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.directory = directory
+		self.width, self.height = width, height
+		self.format = format
+		self.size = 4*width*height # bytes, BGRA
+		self.nCapture = 0          # frames handed to the writer
+		self.nDropped = 0          # frames lost because the writer was behind
+
+		# pixel buffer objects, their fences and the information of the frame in them
+		self.buffers = np.atleast_1d(glGenBuffers(nBuffer)).tolist()
+		for buffer in self.buffers:
+			glBindBuffer(GL_PIXEL_PACK_BUFFER, buffer)
+			glBufferData(GL_PIXEL_PACK_BUFFER, self.size, None, GL_STREAM_READ)
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+		self.fences = [None]*nBuffer
+		self.infos = [None]*nBuffer
+		self.iBuffer = 0 # next buffer to read into, also the oldest in flight
+
+		# frames go from free to written and back
+		self.free = queue.Queue()
+		for i in range(nQueue):
+			self.free.put(np.zeros((height, width, 4), dtype=np.uint8))
+		self.written = queue.Queue()
+		self.indexFile = open(os.path.join(directory, "frames.csv"), 'w')
+		self.rawFile = open(os.path.join(directory, "frames.raw"), 'wb') if format == "raw" else None
+		self.thread = threading.Thread(target=self.write, name="capture")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def capture(self, nFrame, t, state):
+		"""Start reading the back buffer, frame nFrame shown at time t (s) in state."""
+		# collect the buffers that are done, the oldest first, at least the one that is needed now
+		for i in range(len(self.buffers)):
+			iBuffer = (self.iBuffer + i) % len(self.buffers)
+			if self.fences[iBuffer] is None or not self.collect(iBuffer, wait=(i == 0)):
+				break
+
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, self.buffers[self.iBuffer])
+		glReadBuffer(GL_BACK_LEFT) # the left eye only with quad buffered stereo
+		glPixelStorei(GL_PACK_ALIGNMENT, 4)
+		glReadPixels(0, 0, self.width, self.height, GL_BGRA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+		self.fences[self.iBuffer] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+		self.infos[self.iBuffer] = (nFrame, t, state)
+		self.iBuffer = (self.iBuffer + 1) % len(self.buffers)
+
+	def collect(self, iBuffer, wait=False):
+		"""
+		Hand the frame in buffer iBuffer to the writer if the video card is
+		done with it, return False if it is not. Waits for it if wait is True.
+		"""
+		timeout = 1000000000 if wait else 0 # ns
+		status = glClientWaitSync(self.fences[iBuffer], GL_SYNC_FLUSH_COMMANDS_BIT, timeout)
+		if status not in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+			if wait:
+				logging.warning("frame capture timed out")
+			else:
+				return False
+		glDeleteSync(self.fences[iBuffer])
+		self.fences[iBuffer] = None
+		try:
+			frame = self.free.get_nowait()
+		except queue.Empty:
+			self.nDropped += 1
+			return True
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, self.buffers[iBuffer])
+		pointer = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, self.size, GL_MAP_READ_BIT)
+		if pointer:
+			ctypes.memmove(frame.ctypes.data, pointer, self.size)
+		glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+		if pointer:
+			self.written.put((self.nCapture, self.infos[iBuffer], frame))
+			self.nCapture += 1
+		else:
+			self.free.put(frame)
+		return True
+
+	def write(self):
+		"""worker thread function"""
+		while True:
+			item = self.written.get()
+			if item is None:
+				break
+			iCapture, (nFrame, t, state), frame = item
+			if self.format == "png":
+				writePng(os.path.join(self.directory, "frame{:06d}.png".format(iCapture)), frame[::-1,:,2::-1])
+			else:
+				self.rawFile.write(frame.tobytes())
+			print("{},{},{:.6f},{}".format(iCapture, nFrame, t, state), file=self.indexFile)
+			self.free.put(frame)
+
+	def close(self):
+		"""Write the frames that are still in flight, stop the writer and delete the buffers."""
+		for i in range(len(self.buffers)):
+			iBuffer = (self.iBuffer + i) % len(self.buffers)
+			if self.fences[iBuffer] is not None:
+				self.collect(iBuffer, wait=True)
+		self.written.put(None)
+		self.thread.join()
+		self.indexFile.close()
+		if self.rawFile is not None:
+			self.rawFile.close()
+		glDeleteBuffers(len(self.buffers), np.array(self.buffers, dtype=np.uint32))
+		logging.info("captured {} frames of {}x{} to {}, {} dropped".format(self.nCapture, self.width, self.height, self.directory, self.nDropped))
@@ -19,9 +19,8 @@ along with Sleelab.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from __future__ import print_function
-import sys, math, time, numpy as np, random, serial, ctypes, re
-import fpclient, sledclient, sledclientsimulator, transforms, objects, shader,conditions
-import numpy.matlib
+import sys, os, math, time, numpy as np, random, serial, ctypes, re
+import fpclient, sledclient, sledclientsimulator, transforms, objects, shader, conditions, physics, trajectorycache, metrics, meshcache, glstate, frametiming, capture, recording
 
 from rusocsci import buttonbox
 
@@ -67,6 +66,14 @@ class Field(QGLWidget):
 	dEyes     = 0.063                       # m, distance between the eyes, now exp. var
 	dScreen   = np.array([2.728, 1.02])     # m, size of the screen
 	tMovement = 1.5                         # s, Movement time of sled
+	fFrame    = 120.0                       # Hz, display refresh rate, frame rate of the ball trajectories
+	cacheDirectory = "cache"                # directory of the precomputed ball trajectories
+	session        = None                   # part of the trajectory seeds, set when an experiment is loaded
+	dNearCrossing  = 0.12                   # m, centre distance below which two balls count as crossing
+	renderType     = "mesh"                 # "mesh" or "impostor" (one ray cast quad per ball)
+	sphereLevels   = ((24, 18),)            # (nSlices, nStacks) of the ball meshes, coarse to fine, e.g. ((8, 6), (12, 9), (24, 18), (48, 36)) for level of detail
+	captureDirectory = None                 # directory to write every displayed frame to, None for no capture
+	captureFormat    = "png"                # "png" (image sequence) or "raw" (one file of BGRA frames)
 	#balls
 	rBalls      = .04                        # m
 	ballCollide = False
@@ -96,12 +103,24 @@ class Field(QGLWidget):
 			logging.warning("Setting swapinterval not possible, expect synching problems")
 		if not self.format().doubleBuffer():
 			logging.warning("Could not get double buffer; results will be suboptimal")
+		self.setAutoBufferSwap(False) # swapped in paintGL, so that the swap can be timed
+		self.frameTimer = frametiming.FrameTimer(self.fFrame, self.format().swapInterval())
 			
 		self.tOld         = -1
 
 		self.fadeFactor = 1.0         # no fade, fully exposed
 		self.running = False
-		self.conditions = conditions.Conditions(dataKeys=['subject','pCorrect','response','trajectFile'])
+		self.metrics = metrics.CrowdingMetrics(self.dNearCrossing)
+		self.conditions = conditions.Conditions(dataKeys=['subject','session','pCorrect','response','trajectFile']+list(self.metrics.keys)+list(frametiming.FrameTimer.keys))
+		self.trajectoryCache = trajectorycache.TrajectoryCache(self.cacheDirectory)
+		self.balls = physics.BallState(3 if self.dimType=="3D" else 2) # fixed buffers for positions and colors, reused every trial
+		self.projection = transforms.StereoProjection()   # MVP and position per eye
+		self.intensities = np.ones(2, dtype='float32')     # per eye, of the fixation cross and of the balls while running
+		self.fullIntensities = np.ones(2, dtype='float32') # per eye, of the balls in the other states
+		self.colors = np.zeros((0, 3), dtype='float32')    # per ball, in the current state
+		self.updateIntensities()
+		self.frameCapture = None # made in paintGL when captureDirectory is set
+		self.recorder = None     # displayed ball positions of every frame, see openRecording()
 		
 		try:
 			self.shutter = buttonbox.Buttonbox() # optionally add port="COM17"
@@ -113,6 +132,14 @@ class Field(QGLWidget):
 		self.quit()
 
 	def quit(self):
+		if hasattr(self, "meshes"):
+			self.makeCurrent()
+			self.stopCapture()
+			self.meshes.release()
+			del self.meshes # quit() runs again from __del__, release only once
+		if self.recorder is not None:
+			self.recorder.close()
+			self.recorder = None
 		if hasattr(self, "sledClient") and hasattr(self.sledClient, "stopStream"):
 			print("closing sled client") # logger may not exist anymore
 			self.sledClient.stopStream()
@@ -138,19 +165,22 @@ class Field(QGLWidget):
 			QTimer.singleShot(4000,self.changeState) #length of viewing targets
 		elif self.state == "start":
 			self.state = "running"
-			self.startime=time.time()
+			self.startime=frametiming.clock()
 			self.sledClient.sendCommand("Sinusoid Start" +str(self.conditions.trial['amplitude']) +str(self.conditions.trial['period']))
-			print('{"TrialData'+'": [ ',file=self.savefile)
-			print("[{:.6f},{:s}],".format(time.time()-self.startime, ",".join(map(str,self.pBalls.ravel().tolist()))),file=self.savefile)
+			self.recorder.startTrial(self.conditions.iTrial, self.conditions.iCondition, self.nBalls)
+			self.recorder.record(0.0, self.pBalls[:, :self.balls.nDim])
 			self.motionTrigger=1 #run in start state
+			self.frameTimer.startTrial()
 			#change colours fade in (need to determine targets)
 			#fade in eg display objects
 			QTimer.singleShot(self.lTrial*1000,self.changeState) #length of run
 		elif self.state =="running":
 			self.state = "response"
 			self.sledClient.sendCommand("Sinusoid Stop") 
-			print("]}",file=self.savefile)
+			self.recorder.endTrial()
 			self.motionTrigger=0
+			self.metrics.store(self.conditions.trial)
+			self.frameTimer.store(self.conditions.trial)
 			self.resColor(relative=0)
 			self.parent().downAction.setEnabled(True)
 			self.parent().upAction.setEnabled(True)
@@ -167,10 +197,13 @@ class Field(QGLWidget):
 			self.changeState()
 		else:
 			logging.warning("state unknown: {}".format(self.state))
+		self.updateColors()
+		self.update() # restarts the frame loop in the active states
 	
 	def addData(self, data):
 		self.conditions.trial['pCorrect']= data  #str(self.pCorrect) try getting rid of data key
 		self.conditions.trial['subject'] = self.subject # not very useful to store for each trial, but it has to go somewere
+		self.conditions.trial['session'] = self.session # part of the trajectory seeds
 		self.responses[self.selected.astype(int)]=1
 		self.responses=self.responses.astype(int).tolist()
 		self.conditions.trial['response']=self.responses
@@ -209,6 +242,7 @@ class Field(QGLWidget):
 			self.parent().leftAction.setEnabled(False)
 			self.parent().rightAction.setEnabled(False)
 			logging.info("stereo disabled")
+		self.updateIntensities()
 		self.update()
 
 
@@ -220,14 +254,38 @@ class Field(QGLWidget):
 		elif abs(self.stereoIntensityLevel + relative) < 10:
 			self.stereoIntensityLevel += relative
 		self.parent().statusBar().showMessage("Stereo intensity: {}".format(self.stereoIntensityLevel))
+		self.updateIntensities()
 		self.update()
+
+	def updateIntensities(self):
+		"""Intensity per eye, from stereoIntensityLevel."""
+		for iEye, eye in enumerate(self.views):
+			if eye == 'LEFT':
+				self.intensities[iEye] = (1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1)[self.stereoIntensityLevel-10]
+			elif eye == 'RIGHT':
+				self.intensities[iEye] = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0)[self.stereoIntensityLevel-10]
+			else:
+				self.intensities[iEye] = 1.0
 	
 	def resColor(self, relative=None): #response ball color function
 		self.currentTarget = (self.currentTarget + relative)%self.nBalls
-		self.resBallColor=np.ones((self.nBalls,3), 'f') #needs to be redefined each ball change move it
+		self.resBallColor[...] = 1
 		self.resBallColor[self.currentTarget,:]= [1,0,0] #set to red 
+		self.updateColors()
 		self.update()
 
+	def updateColors(self):
+		"""Fill the ball colors of the current state, they are uploaded with the next frame."""
+		if self.state == "start":
+			np.copyto(self.colors, self.ballColor)
+		elif self.state in ("running", "replay"):
+			self.colors[...] = 1 # intensity per eye is a uniform
+		elif self.state == "response":
+			np.copyto(self.colors, self.resBallColor)
+		else: # wait, home, sleep
+			self.colors[...] = 0
+		self.colorsDirty = True
+
 	def resBall(self):
 		#if 
 		#self.ballSelected < self.nTargets
@@ -248,14 +306,15 @@ class Field(QGLWidget):
 			#self.conditions.nextTrial()
 			#print(self.conditions.iTrial)
 
-	def viewerMove(self, x, y=None):
-		""" Move the viewer's position """
+	def viewerMove(self, x, y=None, repaint=True):
+		""" Move the viewer's position, repaint is False from within the frame loop """
 		#print("viewermove: ({}, {})".format(x, y))
 		self.pViewer[0] = x
 		self.pViewer[1] = 0
 		if y != None:
 			self.pViewer[1] = y
-		self.update()
+		if repaint:
+			self.update()
 	
 	
 	def mouseMoveEvent(self, event):
@@ -269,6 +328,13 @@ class Field(QGLWidget):
 				self.dScreen[1]*(.5-event.posF().y()/self.size().height()) # mouse y-axis is inverted
 				)
 
+	def openRecording(self, fileName):
+		"""Record the ball positions of all following trials in fileName, see recording.py."""
+		if self.recorder is not None:
+			self.recorder.close()
+		self.filename = fileName
+		self.recorder = recording.Recorder(fileName, nDim=self.balls.nDim)
+
 	def connectSledServer(self, server=None):
 		logging.debug("requested sled server: " + str(server))
 		self.sledClientSimulator = sledclientsimulator.SledClientSimulator() # for visual only mode
@@ -304,137 +370,50 @@ class Field(QGLWidget):
 			self.positionClient.startStream()          # start the synchronization stream. 
 			time.sleep(2)
 
+	def trialParameters(self):
+		"""Parameters that determine the ball trajectory of the current trial."""
+		seed = trajectorycache.seed(self.subject, self.session, self.conditions.iCondition, self.conditions.trial['iTrial'])
+		return trajectorycache.parameters(self, self.conditions.trial, seed)
+
+	def precomputeTrajectories(self):
+		"""Generate the trajectories of all trials of the loaded experiment in parallel, if not cached yet."""
+		self.trajectoryCache.precompute(trajectorycache.sessionParameters(self.conditions, self, self.subject, self.session))
+
 	def initializeObjects(self):
 
 	#velocity is sampled from a norm sphere and multipled to create equal speed for each object
 		# see sampling_test.py for simulation of the sampling.
 		# need to make sure we recall this at beginning of new trial
-		#adding 2-d change
-		if self.dimType=="3D":
-			self.sBalls=self.conditions.trial['sBalls']
-			self.nBalls=self.conditions.trial['nBalls'] #required parameters go here.
-			self.nTargets=self.conditions.trial['nTargets']
-			self.lTrial=self.conditions.trial['lTrial']
-			self.selected=np.zeros(self.conditions.trial['nTargets']).astype(np.float32)
-			self.ballSelected=0
-			self.nCorrect=0
-			self.pCorrect=float('nan')
-			self.responses=np.zeros(self.conditions.trial['nBalls']).astype(np.float32)
-
-			Angles           = np.random.uniform(0, 1, (self.nBalls, 2)).astype(np.float32) 
-			Theta            = 2*math.pi*Angles[:,0]
-			Phi              = np.arccos(2*Angles[:,1]-1)
-			self.motionTrigger = 0 #predefined
-			if self.moveType == "ConstantVelocity":
-				self.vBalls      = np.zeros((self.nBalls,3), dtype="float32")
-				self.vBalls[:,0] =(np.cos(Theta)*np.sin(Phi))*self.sBalls  # m/s x
-				self.vBalls[:,1] =(np.sin(Theta)*np.sin(Phi))*self.sBalls # m/s y 
-				self.vBalls[:,2] =(np.cos(Phi)*self.sBalls)               # m/s z
-
-			elif self.moveType == "virtualSpring":
-				self.pBalls      = np.zeros((self.nBalls,3), dtype="float32")
-				self.vBalls      = np.zeros((self.nBalls,3), dtype="float32")
-
-			distance=np.zeros((self.nBalls*self.nBalls))
-			distance[0]=1 
-			while (sum(distance)>0):	# repeat until no balls overlap
-				distance=np.zeros((self.nBalls*self.nBalls))
-				self.pBalls=np.zeros((self.nBalls,3), dtype="float32")# m
-				self.pBalls[:,0] = np.random.uniform(self.wall[0][0],self.wall[0][1], (self.nBalls)).astype(np.float32) #initialize balls to be between walls
-				self.pBalls[:,1] = np.random.uniform(self.wall[1][0],self.wall[1][1], (self.nBalls)).astype(np.float32)
-				self.pBalls[:,2] = np.random.uniform(self.wall[2][0],self.wall[2][1], (self.nBalls)).astype(np.float32)
-				for i in range(0,self.nBalls-1):
-					for j in range(i+1,self.nBalls):
-						if np.sqrt(sum(np.square(self.pBalls[i,:] -self.pBalls[j,:]))) < self.rBalls*2: #check euclidean distance
-							distance[i]=1
-		#if self.moveType=="virtualSpring":
-			self.targets=np.random.permutation(self.nBalls) #create randon permutation of balls
-			self.targets=self.targets[0:self.nTargets] #define targets
-			self.pBallStart=self.pBalls[self.targets,:] #randomise and find targets
-			self.currentTarget=0 #start response from first balls
-			self.ballColor=np.ones((self.nBalls,3), 'f') #everything grey
-			self.ballColor[self.targets,:]=numpy.matlib.repmat([1,0,0],self.nTargets,1) #num targets cannot be less than num of balls
-			self.resBallColor=np.ones((self.nBalls,3), 'f') #initiale response balls color
-
-
-		else:
-			self.sBalls=self.conditions.trial['sBalls']
-			self.nBalls=self.conditions.trial['nBalls'] #required parameters go here.
-			self.nTargets=self.conditions.trial['nTargets']
-			self.lTrial=self.conditions.trial['lTrial']
-			self.selected=np.zeros(self.conditions.trial['nTargets']).astype(np.float32)
-			self.ballSelected=0
-			self.nCorrect=0
-			self.pCorrect=float('nan')
-			self.responses=np.zeros(self.conditions.trial['nBalls']).astype(np.float32)
-
-			Angles           = np.random.uniform(0, 1, (self.nBalls, 2)).astype(np.float32) 
-			Theta            = 2*math.pi*Angles[:,0]
-			Phi              = np.arccos(2*Angles[:,1]-1)
-			self.motionTrigger = 0 #predefined
-			if self.moveType == "ConstantVelocity":
-				self.vBalls      = np.zeros((self.nBalls,3), dtype="float32")
-				self.vBalls[:,0] =(np.cos(Theta)*np.sin(Phi))*self.sBalls  # m/s x
-				self.vBalls[:,1] =(np.sin(Theta)*np.sin(Phi))*self.sBalls # m/s y 
-				#self.vBalls[:,2] =(np.cos(Phi)*self.sBalls)               # m/s z
-
-			elif self.moveType == "virtualSpring":
-				self.pBalls      = np.zeros((self.nBalls,3), dtype="float32")
-				self.vBalls      = np.zeros((self.nBalls,3), dtype="float32")
-
-			distance=np.zeros((self.nBalls*self.nBalls))
-			distance[0]=1 
-			while (sum(distance)>0):	# repeat until no balls overlap
-				distance=np.zeros((self.nBalls*self.nBalls))
-				self.pBalls=np.zeros((self.nBalls,3), dtype="float32")# m
-				self.pBalls[:,0] = np.random.uniform(self.wall[0][0],self.wall[0][1], (self.nBalls)).astype(np.float32) #initialize balls to be between walls
-				self.pBalls[:,1] = np.random.uniform(self.wall[1][0],self.wall[1][1], (self.nBalls)).astype(np.float32)
-				if self.dimType=="3D":
-					self.pBalls[:,2] = np.random.uniform(self.wall[2][0],self.wall[2][1], (self.nBalls)).astype(np.float32)
-				else:
-					self.pBalls[:,2] = np.zeros((self.nBalls), dtype="float32")
-				for i in range(0,self.nBalls-1):
-					for j in range(i+1,self.nBalls):
-						if np.sqrt(sum(np.square(self.pBalls[i,:] -self.pBalls[j,:]))) < self.rBalls*2: #check euclidean distance
-							distance[i]=1
-		#if self.moveType=="virtualSpring":
-			self.targets=np.random.permutation(self.nBalls) #create randon permutation of balls
-			self.targets=self.targets[0:self.nTargets] #define targets
-			self.pBallStart=self.pBalls[self.targets,:] #randomise and find targets
-			self.currentTarget=0 #start response from first balls
-			self.ballColor=np.ones((self.nBalls,3), 'f') #everything grey
-			self.ballColor[self.targets,:]=numpy.matlib.repmat([1,0,0],self.nTargets,1) #num targets cannot be less than num of balls
-			self.resBallColor=np.ones((self.nBalls,3), 'f') #initiale response balls color
-
-
-
-
-
-
-
-		# set uniform variables and set up VBO's for the attribute values
-		# reference triangles, do not move in model coordinates
-		# position of the center
-		
-		p, t, n, pTex = objects.sphere(1.0)
-
-		# each vertex has:
-		# 3 floats for position (x, y, z)
- 		self.ballVertices = vbo.VBO(p, target=GL_ARRAY_BUFFER, usage=GL_STATIC_DRAW)
-		self.ballIndices = vbo.VBO(t, target=GL_ELEMENT_ARRAY_BUFFER)
-		
-		# fixation cross
-		xFixation = self.pViewer[0]
-
-		p = np.hstack((
-			np.array((xFixation-.1, 0, 0, 
-			 xFixation+.1, 0, 0, 
-			 xFixation, .1, 0), dtype='float32'), 
-			np.array((0,0,1, 0,0,1, 0,0,1), dtype='float32')
-		))
-
-		# send the whole array to the video card
-		self.fixationVertices = vbo.VBO(p, usage='GL_STATIC_DRAW')
+		self.sBalls=self.conditions.trial['sBalls']
+		self.nBalls=self.conditions.trial['nBalls'] #required parameters go here.
+		self.nTargets=self.conditions.trial['nTargets']
+		self.lTrial=self.conditions.trial['lTrial']
+		self.selected=np.zeros(self.conditions.trial['nTargets']).astype(np.float32)
+		self.ballSelected=0
+		self.nCorrect=0
+		self.pCorrect=float('nan')
+		self.responses=np.zeros(self.conditions.trial['nBalls']).astype(np.float32)
+
+		self.motionTrigger = 0 #predefined
+		self.trajectory = self.trajectoryCache.get(self.trialParameters()) # memory mapped, (nFrame, nBalls, nDim)
+		self.balls.resize(self.nBalls)
+		self.pBalls = self.balls.p3 # updated in place during the trial, z stays 0 in 2D
+		np.copyto(self.pBalls[:,:self.balls.nDim], self.trajectory[0])
+		self.targets=np.random.permutation(self.nBalls) #create randon permutation of balls
+		self.targets=self.targets[0:self.nTargets] #define targets
+		self.pBallStart=self.pBalls[self.targets,:] #randomise and find targets
+		self.currentTarget=0 #start response from first balls
+		self.ballColor=self.balls.color
+		self.ballColor[...]=1 #everything grey
+		self.ballColor[self.targets,:]=[1,0,0] #num targets cannot be less than num of balls
+		self.resBallColor=np.ones((self.nBalls,3), 'f') #initiale response balls color
+		self.metrics.reset(self.nBalls, self.targets, len(self.trajectory))
+
+		self.colors = np.zeros((self.nBalls, 3), dtype='float32')
+		self.updateColors()
+		self.iFrame = 0
+		self.positionsDirty = True
+		self.xFixation = self.pViewer[0] # fixation cross stays where the viewer was at the start of the trial
 
 
 	def initializeGL(self):
@@ -442,33 +421,52 @@ class Field(QGLWidget):
 		glEnable(GL_MULTISAMPLE)         # anti aliasing
 		glClearColor(0.0, 0.0, 0.0, 1.0) # blac k background
 		
-		# set up the shaders
-		self.program = shader.initializeShaders(shader.vs, shader.fs)
-		# constant uniforms
-		glUniform1f(glGetUniformLocation(self.program, "rBalls"), self.rBalls)
-		if self.dimType=="3D":
-			glUniform1f(glGetUniformLocation(self.program, "diffuse"), 1.0)
-			glUniform1f(glGetUniformLocation(self.program, "ambient"), 0.3)
-		else:
-			glUniform1f(glGetUniformLocation(self.program, "diffuse"), 0.0)
-			glUniform1f(glGetUniformLocation(self.program, "ambient"), 0.6)
-
+		# set up the shaders, balls have their own program if they are drawn as impostors
+		shaderCache = os.path.join(self.cacheDirectory, "shaders") # linked program binaries
+		if self.renderType == "impostor":
+			self.ballProgram = shader.initializeShaders(shader.impostorVs, shader.impostorFs, cacheDirectory=shaderCache)
+			self.initializeUniforms(self.ballProgram)
+		elif self.renderType != "mesh":
+			logging.error("renderType not recognized: "+self.renderType)
+		self.program = shader.initializeShaders(shader.vs, shader.fs, cacheDirectory=shaderCache)
+		self.initializeUniforms(self.program)
 
 		# dynamic uniforms
-		self.MVPLocation = glGetUniformLocation(self.program, "MVP")
 		self.nFrameLocation = glGetUniformLocation(self.program, "nFrame")
 		self.fadeFactorLocation = glGetUniformLocation(self.program, "fadeFactor")
-
-		self.colorLocation = glGetUniformLocation(self.program, "color")
-		self.offsetLocation = glGetUniformLocation(self.program, "offset")
-		# attributes
-		self.positionLocation = glGetAttribLocation(self.program, 'position')
-		#self.normalLocation = glGetAttribLocation(self.program, 'normal')
-		
-		glUniform3f(self.colorLocation, 1,0,1)
+		if self.renderType != "impostor":
+			self.ballProgram = self.program
+		self.viewLocations = self.uniformLocations(self.program)
+		self.ballViewLocations = self.uniformLocations(self.ballProgram)
+		glEnable(GL_CLIP_DISTANCE0) # the middle of the screen in single pass side-by-side stereo
+		self.vsync = self.format().swapInterval() > 0 # swapBuffers waits for the vertical sync
+
+		# attributes, offset and color are per instance for the balls and constant for the fixation cross
+		glVertexAttrib3f(shader.offsetLocation, 0, 0, 0)
+		glVertexAttrib3f(shader.colorLocation, 1, 1, 1)
 		glUniform1f(self.fadeFactorLocation, self.fadeFactor)
+
+		# buffers and vertex arrays that are reused by all trials
+		self.meshes = meshcache.MeshCache(self.sphereLevels)
+		self.glState = glstate.GLState() # all program, vertex array and per frame uniform changes go through this
+		self.glState.useProgram(self.program)
 		
-		self.initializeObjects()
+		if self.state != "replay": # a replay has its balls already
+			self.initializeObjects()
+
+	def initializeUniforms(self, program):
+		"""Set the uniforms that are constant during the experiment, program must be in use."""
+		glUniform1f(glGetUniformLocation(program, "rBalls"), self.rBalls)
+		if self.dimType=="3D":
+			glUniform1f(glGetUniformLocation(program, "diffuse"), 1.0)
+			glUniform1f(glGetUniformLocation(program, "ambient"), 0.3)
+		else:
+			glUniform1f(glGetUniformLocation(program, "diffuse"), 0.0)
+			glUniform1f(glGetUniformLocation(program, "ambient"), 0.6)
+
+	def uniformLocations(self, program):
+		"""Locations of the uniforms that are set per frame, -1 if program does not use them."""
+		return dict((name, glGetUniformLocation(program, name)) for name in ("MVP", "pEye", "intensity", "nEye", "firstEye"))
 
 	def resizeGL(self, width, height):
 		logging.info("resize: {}, {}".format(width, height))
@@ -476,55 +474,148 @@ class Field(QGLWidget):
 		self.height = height
 		
 	def move(self):
-		if self.moveType=="ConstantVelocity":
-		#acceleration and time
-			t = time.time()
-			dt = t - self.tOld
-			self.tOld = t
-			dt = min(0.100, dt) # rather violate physics than make a huge timestep, needed after pause
-			if self.motionTrigger==0: #don't move balls
-				self.pBalls = self.pBalls
-
-
-			elif self.motionTrigger==1: #move balls
-				print("[{:.6f},{:s}],".format(time.time()-self.startime, ",".join(map(str,self.pBalls.ravel().tolist()))),file=self.savefile)
-				# ball displacement (semi implicit Euler)
-				self.pBalls = self.pBalls + self.vBalls * dt
-				if self.wallCollide:
-					for i in range(self.nBalls):
-						for dim in range(3): # todo: vectorize
-							if self.pBalls[i][dim] < self.wall[dim][0]:
-								self.pBalls[i][dim] =  2*self.wall[dim][0] - self.pBalls[i][dim]
-								self.vBalls[i][dim] =  -self.vBalls[i][dim]
-							elif self.pBalls[i][dim] > self.wall[dim][1]:
-								self.pBalls[i][dim] =  2*self.wall[dim][1] - self.pBalls[i][dim]
-								self.vBalls[i][dim] =  -self.vBalls[i][dim]
-				
-		elif self.moveType=="virtualSpring":
-
-			sigV=0.005
-			sigX=0.3 #this needs to be redined to update
-			L= 0.9#dampening/ inertia
-			K=((L+1)*sigV**2)/(2*sigX**2)
-			sig=0.5*np.sqrt(sigV**2*(4*sigX**2-4*L**2*sigX**2-sigV**2+L**2*sigV**2)/sigX**2)
-			t = time.time()
-			#dt = t - self.tOld
-			dt=1
-			self.tOld = t
-			if self.motionTrigger==0: #don't move balls
-				self.pBalls = self.pBalls
-
-
-			elif self.motionTrigger==1: #move balls
-				print("[{:.6f},{:s}],".format(time.time()-self.startime, ",".join(map(str,self.pBalls.ravel().tolist()))),file=self.savefile)
-				# ball displacement (semi implicit Euler)
-				if self.dimType =="3D":
-					self.vBalls = L*self.vBalls + K*(0-self.pBalls)*dt + np.sqrt(dt)*np.random.normal(0,sig,(self.nBalls,3)).astype(np.float32)
-					self.pBalls = self.pBalls + self.vBalls
-				else:
-					self.vBalls = L*self.vBalls + K*(0-self.pBalls)*dt + np.sqrt(dt)*np.random.normal(0,sig,(self.nBalls,3)).astype(np.float32)
-					self.vBalls[:,2]=np.zeros((self.nBalls)) # z axis always zero 
-					self.pBalls = self.pBalls + self.vBalls
+		"""Show the precomputed trajectory frame belonging to the time since the start of the trial."""
+		if self.state == "replay":
+			self.replayFrame()
+		elif self.motionTrigger==1: #move balls
+			self.recorder.record(frametiming.clock()-self.startime, self.pBalls[:, :self.balls.nDim]) # p3 is padded to 3D for OpenGL
+			iFrame = min(int((frametiming.clock()-self.startime)*self.fFrame), len(self.trajectory)-1)
+			if iFrame != self.iFrame:
+				self.iFrame = iFrame
+				np.copyto(self.pBalls[:,:self.balls.nDim], self.trajectory[iFrame])
+				self.positionsDirty = True
+			self.metrics.update(self.pBalls)
+
+	def startReplay(self, fileName, k=0):
+		"""
+		Show the k'th trial of a recording (see recording.py) instead of the
+		experiment. Frames are read from disk when they are shown. Raises
+		ValueError if there is no such trial or it has no frames.
+		"""
+		replay = recording.Recording(fileName)
+		if not 0 <= k < len(replay):
+			raise ValueError("no trial {} in {}, it has {} trials".format(k, fileName, len(replay)))
+		entry = replay.index[k]
+		if entry['nFrame'] == 0:
+			raise ValueError("trial {} in {} has no frames".format(k, fileName))
+		self.replay = replay
+		logging.info("replay trial {} (condition {}) of {}".format(entry['iTrial'], entry['iCondition'], fileName))
+		self.replayTimes = self.replay.times(k)         # memory mapped
+		self.replayPositions = self.replay.positions(k) # memory mapped, (nFrame, nBalls, nDim)
+		self.nBalls = int(entry['nBalls'])
+		self.balls.resize(self.nBalls)
+		self.pBalls = self.balls.p3
+		self.pBalls[...] = 0
+		self.colors = np.zeros((self.nBalls, 3), dtype='float32')
+		self.motionTrigger = 0
+		self.xFixation = self.pViewer[0]
+		self.iFrame = -1
+		self.replayTime = 0.0   # s, in the recording, at replayClock
+		self.replayClock = frametiming.clock()
+		self.replaySpeed = 1.0
+		self.replayPlaying = True
+		self.state = "replay"
+		self.updateColors()
+		self.replayFrame()
+		self.update()
+
+	def replayPosition(self):
+		"""Time in the recording that is shown now, s."""
+		if self.replayPlaying:
+			return self.replayTime + self.replaySpeed*(frametiming.clock()-self.replayClock)
+		return self.replayTime
+
+	def replayAnchor(self):
+		"""Restart the replay clock at the time shown now, before changing the speed, time or pause."""
+		self.replayTime = min(max(self.replayPosition(), 0.0), float(self.replayTimes[-1]))
+		self.replayClock = frametiming.clock()
+
+	def replayPlay(self, playing=None):
+		"""Play or pause the replay, toggle if playing is None."""
+		self.replayAnchor()
+		self.replayPlaying = not self.replayPlaying if playing is None else playing
+		if self.replayPlaying and self.replayTime >= self.replayTimes[-1]:
+			self.replayTime = 0.0 # play again from the start
+		self.replayFrame()
+		self.update()
+
+	def replaySeek(self, t=None, relative=None):
+		"""Go to t s in the trial, or relative s from the time shown now."""
+		self.replayAnchor()
+		if relative is not None:
+			t = self.replayTime + relative
+		self.replayTime = min(max(t, 0.0), float(self.replayTimes[-1]))
+		self.replayFrame()
+		self.update()
+
+	def replaySetSpeed(self, speed=None, factor=None):
+		"""Set the replay speed (1 is real time), or multiply it by factor."""
+		self.replayAnchor()
+		self.replaySpeed = speed if factor is None else self.replaySpeed*factor
+		logging.info("replay speed: {}".format(self.replaySpeed))
+		self.update()
+
+	def replayFrame(self):
+		"""Show the recorded frame belonging to the replay time, only that frame is read from disk."""
+		t = self.replayPosition()
+		nFrame = len(self.replayTimes)
+		iFrame = min(max(int(np.searchsorted(self.replayTimes, t, 'right'))-1, 0), nFrame-1)
+		if self.replayPlaying and t >= self.replayTimes[-1]:
+			self.replayPlaying = False # stop at the last frame
+			self.replayTime = float(self.replayTimes[-1])
+		if iFrame != self.iFrame:
+			self.iFrame = iFrame
+			nDim = min(self.replayPositions.shape[2], 3)
+			np.copyto(self.pBalls[:,:nDim], self.replayPositions[iFrame,:,:nDim])
+			self.positionsDirty = True
+
+	def ballDiameter(self):
+		"""On-screen diameter in pixels of the ball nearest to the viewer."""
+		z = self.pViewer[2]
+		zBall = self.pBalls[:,2].max() if len(self.pBalls) else 0
+		width = self.width/2 if len(self.views) == 2 and not self.format().stereo() else self.width
+		return 2*self.rBalls*(z-self.zFocal)/(z-zBall)*width/self.dScreen[0]
+
+	def setViewUniforms(self, locations, nEye, firstEye, intensities):
+		state = self.glState
+		state.uniform(glUniformMatrix4fv, locations["MVP"], 2, GL_FALSE, self.projection.mvp)
+		state.uniform(glUniform3fv, locations["pEye"], 2, self.projection.pEye)
+		state.uniform(glUniform1fv, locations["intensity"], 2, intensities)
+		state.uniform(glUniform1i, locations["nEye"], nEye)
+		state.uniform(glUniform1i, locations["firstEye"], firstEye)
+
+	def drawScene(self, nEye, firstEye):
+		"""
+		Draw the balls and the fixation cross for eye firstEye, or for both
+		eyes side-by-side in one pass if nEye is 2: every ball is then
+		drawn as two instances and the shaders put each in its half.
+		"""
+		# draw all balls as instances of one sphere (with indices) or of one impostor quad
+		self.glState.useProgram(self.ballProgram)
+		self.setViewUniforms(self.ballViewLocations, nEye, firstEye,
+			self.intensities if self.state == "running" else self.fullIntensities)
+		if self.renderType == "impostor":
+			self.glState.bindVertexArray(self.meshes.ballArray(self.meshes.quad, None, nEye))
+			glDrawArraysInstanced(GL_TRIANGLE_STRIP, 0, 4, nEye*self.nBalls)
+		else:
+			self.glState.bindVertexArray(self.meshes.ballArray(self.ballVertices, self.ballIndices, nEye))
+			glDrawElementsInstanced(GL_TRIANGLES, self.ballIndices.data.size, GL_UNSIGNED_INT, None, nEye*self.nBalls)
+
+		# draw fixation cross as arrays (without indices)
+		self.glState.useProgram(self.program)
+		self.setViewUniforms(self.viewLocations, nEye, firstEye, self.intensities)
+		self.glState.bindVertexArray(self.meshes.fixationArray)
+		# glUniform1f(self.moveFactorLocation, 1.0) #todo: put in MVP
+		glDrawArraysInstanced(GL_TRIANGLES, 0, 1, nEye)
+
+	def uploadInstances(self):
+		"""Upload the ball positions and colors, if they changed."""
+		if self.positionsDirty:
+			self.meshes.upload(self.meshes.offsets, self.pBalls)
+			self.positionsDirty = False
+		if self.colorsDirty:
+			self.meshes.upload(self.meshes.colors, self.colors)
+			self.colorsDirty = False
 
 	nFramePerSecond = 0 # number of frame in this Gregorian 
 	nFrame = 0 # total number of frames
@@ -538,8 +629,9 @@ class Field(QGLWidget):
 			self.nFramePerSecond = 0
 		self.nFramePerSecond += 1
 		"""
+		self.frameTimer.startFrame()
 		
-		if hasattr(self, "positionClient"): # only false if mouse is used
+		if hasattr(self, "positionClient") and self.animating(): # only false if mouse is used, or nothing moves
 			mode = "visual"
 			if mode=='visual':
 				pp = self.sledClientSimulator.getPosition()
@@ -549,85 +641,84 @@ class Field(QGLWidget):
 				logging.error("mode not recognized: "+mode)
 				
 			p = np.array(pp).ravel().tolist()       # python has too many types
-			self.viewerMove(p[0], p[1])         # use x- and y-coordinate of first marker
+			self.viewerMove(p[0], p[1], repaint=False) # use x- and y-coordinate of first marker, scheduleFrame() repaints
+		self.frameTimer.stage(0) # position
 				
 		## set uniform variables
-		if self.nFrameLocation != -1:
-			glUniform1i(self.nFrameLocation, self.nFrame)
-
-		glDrawBuffer(GL_BACK_LEFT)
-		glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-		for eye in self.views:
-			if eye == 'LEFT':
-				xEye = -self.dEyes/2
-				intensityLevel = (1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1)[self.stereoIntensityLevel-10]
-				glUniform3f(self.colorLocation, 0.0, 0.0, 1.0)
-				if not self.format().stereo():
-					# self implemented side-by-side stereo, for instance in sled lab
-					glViewport(0, 0, self.width/2, self.height)
-			elif eye == 'RIGHT':
-				xEye =  self.dEyes/2
-				intensityLevel = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0)[self.stereoIntensityLevel-10]
-				glUniform3f(self.colorLocation, 1.0, 0.0, 0.0)
-				if self.format().stereo():
-					# os supported stereo, for instance nvidia 3d vision
-					glDrawBuffer(GL_BACK_RIGHT)
-					glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-				else:
-					# self implemented side-by-side stereo, for instance in sled lab
-					glViewport(self.width/2, 0, self.width/2, self.height)
-			else:
-				glViewport(0, 0, self.width, self.height)
-				xEye =  0
-				intensityLevel = 1.0
-				
-			# calculate MVP (VP really)
-			z = self.pViewer[2]
-			
-			MVP = transforms.arjan(self.dScreen[0], self.dScreen[1], 
-				z-self.zNear, z-self.zFocal, z-self.zFar,
-				self.pViewer[0]+xEye, self.pViewer[1])
-			glUniformMatrix4fv(self.MVPLocation, 1, GL_FALSE, MVP)
-
-			# enable vertex attributes used in both balls and fixation cross
-			glEnableVertexAttribArray(self.positionLocation)
-			#glEnableVertexAttribArray(self.normalLocation)
-			
-			# draw balls as elements (with indices)
-			self.ballVertices.bind()
-			self.ballIndices.bind()
-			glVertexAttribPointer(self.positionLocation, 3, GL_FLOAT, False, 3*4, self.ballVertices)
-			#glVertexAttribPointer(self.normalLocation, 3, GL_FLOAT, True, 3*4, self.ballVertices)
-				
-			for i in range(self.nBalls): #change ball color depending on state, maybe put in function later
-				if self.state == "wait" or self.state=='home' or self.state=='sleep':
-					glUniform3fv(self.colorLocation, 1, intensityLevel*np.array([0,0,0],"f")) #arjan no f at end, np array is colour
-				elif self.state == "start":
-					glUniform3fv(self.colorLocation, 1, self.ballColor[i])
-				elif self.state == "running":
-					glUniform3fv(self.colorLocation, 1, intensityLevel*np.array([1,1,1],"f"))
-				elif self.state == "response":
-					glUniform3fv(self.colorLocation,1, self.resBallColor[i])
-				glUniform3fv(self.offsetLocation, 1, self.pBalls[i])
-				glDrawElements(GL_TRIANGLES, self.ballIndices.data.size, GL_UNSIGNED_INT, None)
-			self.ballVertices.unbind()
-			self.ballIndices.unbind()
-
-			# draw fixation cross as arrays (without indices)
-			self.fixationVertices.bind() # get data from vbo with vertices
-			glVertexAttribPointer(self.positionLocation, 3, GL_FLOAT, False, 6*4, self.fixationVertices)
-			#glVertexAttribPointer(self.normalLocation, 3, GL_FLOAT, False, 6*4, self.fixationVertices+3)
-			glUniform3fv(self.colorLocation, 1, intensityLevel*np.array([1,1,1],"f"))
-			# glUniform1f(self.moveFactorLocation, 1.0) #todo: put in MVP
-			#xEye =  0
-			glDrawArrays(GL_TRIANGLES, 0, 1)
-			self.fixationVertices.unbind()
-			
+		self.glState.useProgram(self.program)
+		self.glState.uniform(glUniform1i, self.nFrameLocation, self.nFrame)
+
+		self.uploadInstances()
+		self.meshes.fixationCross(self.xFixation)
+		if self.renderType == "mesh":
+			self.ballVertices, self.ballIndices = self.meshes.sphere(self.ballDiameter() if len(self.sphereLevels) > 1 else None)
+
+		# per eye: MVP (VP really) and eye position, left and right eye or only the first for mono
+		z = self.pViewer[2]
+		self.projection.update(self.dScreen[0], self.dScreen[1], 
+			z-self.zNear, z-self.zFocal, z-self.zFar,
+			self.pViewer[0], self.pViewer[1], self.dEyes if len(self.views) == 2 else 0)
+
+		glViewport(0, 0, self.width, self.height)
+		if len(self.views) == 2 and self.format().stereo():
+			# os supported stereo, for instance nvidia 3d vision, one pass per back buffer
+			for iEye, buffer in enumerate((GL_BACK_LEFT, GL_BACK_RIGHT)):
+				glDrawBuffer(buffer)
+				glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+				self.drawScene(1, iEye)
+		else:
+			# mono, or self implemented side-by-side stereo in one pass, for instance in sled lab
+			glDrawBuffer(GL_BACK_LEFT)
+			glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+			self.drawScene(len(self.views), 0)
+		if self.captureDirectory is not None:
+			self.captureFrame()
+		self.frameTimer.stage(1) # draw
+		self.swapBuffers()
+		self.frameTimer.stage(2) # swap
 
 		## schedule next redraw
 
 		#if self.running:
 		self.nFrame += 1
 		self.move()
-		self.update()
+		self.frameTimer.stage(3) # move
+		self.scheduleFrame()
+
+	def captureFrame(self):
+		"""Start reading back the frame that was just drawn, it is written to captureDirectory in the background."""
+		if self.frameCapture is not None and (self.frameCapture.width, self.frameCapture.height) != (self.width, self.height):
+			self.frameCapture.close() # window resized
+			self.frameCapture = None
+		if self.frameCapture is None:
+			self.frameCapture = capture.FrameCapture(self.captureDirectory, self.width, self.height, self.captureFormat)
+		self.frameCapture.capture(self.nFrame, self.frameTimer.times[self.frameTimer.i], self.state)
+
+	def stopCapture(self):
+		"""Write the frames that are still being read back and stop capturing, OpenGL context must be current."""
+		if self.frameCapture is not None:
+			self.frameCapture.close()
+			self.frameCapture = None
+		self.captureDirectory = None
+
+	activeStates = ("start", "running", "response") # painted at the display refresh rate, the others on demand
+	def animating(self):
+		"""True in the active states and while a replay is playing, when every frame is painted."""
+		return self.state in self.activeStates or (self.state == "replay" and self.replayPlaying)
+
+	def scheduleFrame(self):
+		"""
+		Request the next frame while animating(). With vsync swapBuffers
+		paces the frames, otherwise a timer does. In the other states
+		nothing moves and the position client is not polled, they are only
+		repainted by update() calls from state changes, input and mouse
+		viewer movement.
+		"""
+		if not self.animating():
+			return
+		if self.vsync:
+			self.update()
+		else:
+			tNext = self.frameTimer.times[self.frameTimer.i] + 1.0/self.fFrame
+			QTimer.singleShot(max(0, int(1000*(tNext-frametiming.clock()))), self.update)
 
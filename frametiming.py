@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Copyright © 2014, W. van Ham, Radboud University Nijmegen
+This file is part of Sleelab.
+
+Sleelab is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Sleelab is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Sleelab.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Frame timing: when every frame started and how long each stage of it took,
+# in a preallocated ring buffer, and a summary per trial. An interval between
+# frames of k refresh periods means that k-1 vertical syncs were missed.
+
+from __future__ import print_function
+import sys, time, timeit, ctypes, ctypes.util, logging, numpy as np
+
+def linuxMonotonic():
+	"""clock_gettime(CLOCK_MONOTONIC) as a clock function, for python 2 on Linux."""
+	class Timespec(ctypes.Structure):
+		_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+	library = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+	clockGettime = library.clock_gettime
+	clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+	timespec = Timespec()
+	CLOCK_MONOTONIC = 1
+	def clock():
+		if clockGettime(CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+			raise OSError(ctypes.get_errno(), "clock_gettime failed")
+		return timespec.tv_sec + timespec.tv_nsec*1e-9
+	return clock
+
+# s, a clock that never jumps, not even when the system time is set
+try:
+	clock = time.monotonic # python 3.3 and up
+except AttributeError: # python 2
+	if sys.platform.startswith('linux'):
+		clock = linuxMonotonic()
+	elif sys.platform == 'win32':
+		clock = time.clock # QueryPerformanceCounter
+	else:
+		clock = timeit.default_timer
+		logging.warning("no monotonic clock, frame timing uses the wall clock")
+
+class FrameTimer(object):
+	"""
+	Call startFrame() at the start of every frame and stage(iStage) at the
+	end of each stage, in the order of stages. Only the last capacity frames
+	are kept.
+	"""
+	stages = ('position', 'draw', 'swap', 'move')
+	keys = ('nFrame', 'nFrameMissed', 'frameIntervalMean', 'frameIntervalMax') + tuple("t"+s.capitalize() for s in stages)
+
+	def __init__(self, fFrame=120.0, swapInterval=1, capacity=8192, clock=clock):
+		self.clock = clock
+		self.capacity = capacity
+		self.times = np.zeros(capacity)                      # s, start of frame
+		self.durations = np.zeros((capacity, len(self.stages))) # s
+		self.n = 0                                           # number of frames ever started
+		self.iFirst = 0                                      # first frame of the trial
+		self.setRefresh(fFrame, swapInterval)
+
+	def setRefresh(self, fFrame, swapInterval=1):
+		"""Expected interval between frames is swapInterval/fFrame, swapInterval 0 is no vsync."""
+		self.tFrame = max(swapInterval, 1)/float(fFrame)
+
+	def startFrame(self):
+		self.tStage = self.clock()
+		self.i = self.n % self.capacity
+		self.times[self.i] = self.tStage
+		self.n += 1
+
+	def stage(self, iStage):
+		t = self.clock()
+		self.durations[self.i, iStage] = t - self.tStage
+		self.tStage = t
+
+	def startTrial(self):
+		"""Summaries are over the frames from here."""
+		self.iFirst = self.n
+
+	def summary(self):
+		"""Frame statistics of the trial, times in ms, as a dictionary with keys."""
+		iFrame = np.arange(max(self.iFirst, self.n-self.capacity), self.n) % self.capacity
+		intervals = np.diff(self.times[iFrame])
+		nPeriod = np.maximum(np.round(intervals/self.tFrame), 1)
+		values = [len(iFrame), int((nPeriod-1).sum()),
+			1e3*float(intervals.mean()) if len(intervals) else float('nan'),
+			1e3*float(intervals.max()) if len(intervals) else float('nan')]
+		values += (1e3*self.durations[iFrame].mean(0)).tolist() if len(iFrame) else [float('nan')]*len(self.stages)
+		return dict(zip(self.keys, values))
+
+	def store(self, trial):
+		"""Put the summary of the trial in the trial dictionary."""
+		for key, value in self.summary().items():
+			trial[key] = round(value, 3) if isinstance(value, float) else value
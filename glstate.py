@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Copyright © 2014, W. van Ham, Radboud University Nijmegen
+This file is part of Sleelab.
+
+Sleelab is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Sleelab is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Sleelab.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Cache of the OpenGL state that changes during drawing. Every PyOpenGL call
+# costs microseconds of Python, so calls that would not change anything are
+# skipped. Only valid as long as all changes of this state go through one
+# GLState instance, make a new one for a new OpenGL context.
+
+from __future__ import print_function
+import numpy as np
+
+from OpenGL.GL import *
+
+class GLState(object):
+	def __init__(self):
+		self.program = None
+		self.vertexArray = None
+		self.uniforms = {} # (program, location): last value
+
+	def useProgram(self, program):
+		if program != self.program:
+			glUseProgram(program)
+			self.program = program
+
+	def bindVertexArray(self, vertexArray):
+		if vertexArray != self.vertexArray:
+			glBindVertexArray(vertexArray)
+			self.vertexArray = vertexArray
+
+	def uniform(self, function, location, *arguments):
+		"""
+		Call function(location, *arguments), with function one of the
+		glUniform functions and the value as last argument, unless the
+		uniform of the program in use has that value already.
+		"""
+		if location == -1:
+			return
+		key = (self.program, location)
+		value = arguments[-1]
+		old = self.uniforms.get(key)
+		if isinstance(value, np.ndarray):
+			if old is not None and old.shape == value.shape and (old == value).all():
+				return
+			self.uniforms[key] = value.copy()
+		else:
+			if old == value:
+				return
+			self.uniforms[key] = value
+		function(location, *arguments)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Copyright © 2014, W. van Ham, Radboud University Nijmegen
+This file is part of Sleelab.
+
+Sleelab is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Sleelab is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Sleelab.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Vertex buffers and vertex array objects of the meshes, made once when the
+# OpenGL context is initialized and shared by all trials. Must be used and
+# released with the OpenGL context current.
+
+from __future__ import print_function
+import math, numpy as np
+import objects, shader
+
+from OpenGL.GL import *
+from OpenGL.arrays import vbo
+
+class MeshCache(object):
+	"""
+	Unit sphere meshes, the quad of the sphere impostors, the fixation
+	cross and the per-instance buffers with the offset and color of every
+	ball. sphereLevels are (nSlices, nStacks) pairs from coarse to fine,
+	with more than one level the sphere is picked by its size on screen
+	(level of detail).
+	"""
+	pixelsPerSlice = 4 # on-screen length of a slice at the equator of the sphere
+
+	def __init__(self, sphereLevels=((24, 18),)):
+		self.sphereLevels = sphereLevels
+		self.spheres = []
+		for nSlices, nStacks in sphereLevels:
+			p, t, n, pTex = objects.sphere(1.0, nSlices, nStacks)
+			self.spheres.append((
+				vbo.VBO(p, target=GL_ARRAY_BUFFER, usage=GL_STATIC_DRAW),
+				vbo.VBO(t, target=GL_ELEMENT_ARRAY_BUFFER)))
+		self.quad = vbo.VBO(np.array((-1,-1,0, 1,-1,0, -1,1,0, 1,1,0), dtype='float32'), usage=GL_STATIC_DRAW) # triangle strip
+		self.xFixation = None
+		self.fixation = vbo.VBO(np.zeros(18, dtype='float32'), usage='GL_STATIC_DRAW')
+		self.offsets = vbo.VBO(np.zeros(3, dtype='float32'), usage=GL_DYNAMIC_DRAW) # per ball, changes every frame while running
+		self.colors = vbo.VBO(np.zeros(3, dtype='float32'), usage=GL_DYNAMIC_DRAW)  # per ball, changes with the state
+
+		# the fixation cross has no instance arrays, it gets the constant offset and color
+		self.fixationArray = glGenVertexArrays(1)
+		glBindVertexArray(self.fixationArray)
+		self.fixation.bind()
+		glEnableVertexAttribArray(shader.positionLocation)
+		glVertexAttribPointer(shader.positionLocation, 3, GL_FLOAT, False, 6*4, self.fixation)
+		glBindVertexArray(0)
+		self.fixation.unbind()
+		self.ballArrays = {} # (vertices, nEye): vertex array object
+
+	def sphere(self, diameter=None):
+		"""
+		Return the vertex and index VBO of the coarsest sphere that looks
+		round at a diameter of diameter pixels, the finest one if diameter
+		is None.
+		"""
+		if diameter is not None:
+			for (nSlices, nStacks), buffers in zip(self.sphereLevels, self.spheres):
+				if nSlices*self.pixelsPerSlice >= math.pi*diameter:
+					return buffers
+		return self.spheres[-1]
+
+	def fixationCross(self, xFixation):
+		"""Return the VBO of the fixation cross at x-position xFixation, only uploaded again if it moved."""
+		if xFixation != self.xFixation:
+			self.xFixation = xFixation
+			p = np.hstack((
+				np.array((xFixation-.1, 0, 0,
+				 xFixation+.1, 0, 0,
+				 xFixation, .1, 0), dtype='float32'),
+				np.array((0,0,1, 0,0,1, 0,0,1), dtype='float32')
+			))
+			self.fixation.set_array(p)
+			self.fixation.bind() # upload
+			self.fixation.unbind()
+		return self.fixation
+
+	def upload(self, buffer, data):
+		"""Upload the per-instance data, (nBalls, 3) float32, to buffer (offsets or colors)."""
+		buffer.set_array(data)
+		buffer.bind()
+		buffer.unbind()
+
+	def ballArray(self, vertices, indices, nEye):
+		"""
+		Vertex array object of unit mesh vertices with indices (None for the
+		impostor quad) drawn once per ball with the offset and color of the
+		instance buffers. With nEye 2 each ball takes two consecutive instances.
+		"""
+		key = (vertices, nEye)
+		if key not in self.ballArrays:
+			vertexArray = glGenVertexArrays(1)
+			glBindVertexArray(vertexArray)
+			vertices.bind()
+			glEnableVertexAttribArray(shader.positionLocation)
+			glVertexAttribPointer(shader.positionLocation, 3, GL_FLOAT, False, 3*4, vertices)
+			if indices is not None:
+				indices.bind()
+			for location, buffer in ((shader.offsetLocation, self.offsets), (shader.colorLocation, self.colors)):
+				buffer.bind()
+				glEnableVertexAttribArray(location)
+				glVertexAttribPointer(location, 3, GL_FLOAT, False, 3*4, buffer)
+				glVertexAttribDivisor(location, nEye)
+				buffer.unbind()
+			glBindVertexArray(0) # before unbinding, the element buffer binding belongs to the vertex array
+			vertices.unbind()
+			if indices is not None:
+				indices.unbind()
+			self.ballArrays[key] = vertexArray
+		return self.ballArrays[key]
+
+	def release(self):
+		"""Delete all buffers and vertex arrays from the video card."""
+		arrays = [self.fixationArray] + list(self.ballArrays.values())
+		glDeleteVertexArrays(len(arrays), np.array(arrays, dtype=np.uint32))
+		self.ballArrays = {}
+		for vertices, indices in self.spheres:
+			vertices.delete()
+			indices.delete()
+		self.spheres = []
+		self.quad.delete()
+		self.fixation.delete()
+		self.offsets.delete()
+		self.colors.delete()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Copyright © 2014, W. van Ham, Radboud University Nijmegen
+This file is part of Sleelab.
+
+Sleelab is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Sleelab is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Sleelab.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Crowding metrics of the balls, computed online for every displayed frame.
+# All pairwise distances are kept in condensed form (one entry per pair i<j,
+# like scipy.spatial.distance.pdist) in buffers that are allocated once per
+# trial, so that update() does not allocate.
+
+from __future__ import print_function
+import numpy as np
+
+class CrowdingMetrics(object):
+	"""
+	Per frame:
+	minTargetDistractor:  smallest centre distance between a target and a distractor (m)
+	nNearCrossing:        number of pairs that came closer than dNear this frame
+	meanNearestNeighbour: mean over the balls of the distance to the nearest other ball (m)
+	"""
+	keys = ('minTargetDistractor', 'nNearCrossing', 'meanNearestNeighbour')
+
+	def __init__(self, dNear=0.12):
+		self.dNear = dNear # m, centre distance below which a pair counts as crossing
+		self.reset(0, [], 0)
+
+	def reset(self, nBalls, targets, nFrame):
+		"""Start a new trial of nBalls balls with target indices targets, room for nFrame frames."""
+		self.i, self.j = np.triu_indices(nBalls, 1)
+		nPair = len(self.i)
+		self.pI = np.zeros((nPair, 3), dtype=np.float32)
+		self.pJ = np.zeros((nPair, 3), dtype=np.float32)
+		self.d = np.zeros(nPair, dtype=np.float32)
+		self.near = np.zeros(nPair, dtype=bool)
+		self.nearOld = np.zeros(nPair, dtype=bool)
+		self.crossing = np.zeros(nPair, dtype=bool)
+
+		# pairs with exactly one target
+		isTarget = np.zeros(nBalls, dtype=bool)
+		isTarget[targets] = True
+		self.iTargetDistractor = np.flatnonzero(isTarget[self.i] != isTarget[self.j])
+		self.dTargetDistractor = np.zeros(len(self.iTargetDistractor), dtype=np.float32)
+
+		# square matrix with the condensed distances on both sides of an infinite diagonal
+		self.square = np.zeros((nBalls, nBalls), dtype=np.float32)
+		self.square.flat[::nBalls+1] = np.inf
+		self.iUpper = self.i*nBalls + self.j
+		self.iLower = self.j*nBalls + self.i
+		self.nearest = np.zeros(nBalls, dtype=np.float32)
+
+		self.data = np.zeros((max(nFrame, 1), len(self.keys)), dtype=np.float32)
+		self.nFrame = 0
+
+	def update(self, p):
+		"""Add the metrics of positions p, (nBalls, 3)."""
+		np.take(p, self.i, axis=0, out=self.pI, mode='clip')
+		np.take(p, self.j, axis=0, out=self.pJ, mode='clip')
+		self.pI -= self.pJ
+		self.pI *= self.pI
+		self.pI.sum(1, out=self.d)
+		np.sqrt(self.d, out=self.d)
+
+		if self.nFrame == len(self.data):
+			self.data = np.vstack((self.data, np.zeros_like(self.data))) # trial took longer than expected
+		row = self.data[self.nFrame]
+
+		if len(self.dTargetDistractor):
+			np.take(self.d, self.iTargetDistractor, out=self.dTargetDistractor, mode='clip')
+			row[0] = self.dTargetDistractor.min()
+		else:
+			row[0] = np.nan
+
+		np.less(self.d, self.dNear, out=self.near)
+		np.greater(self.near, self.nearOld, out=self.crossing) # near now, not near before
+		row[1] = np.count_nonzero(self.crossing) if self.nFrame else 0
+		self.near, self.nearOld = self.nearOld, self.near
+
+		if len(self.nearest) > 1:
+			np.put(self.square, self.iUpper, self.d)
+			np.put(self.square, self.iLower, self.d)
+			self.square.min(1, out=self.nearest)
+			row[2] = self.nearest.mean()
+		else:
+			row[2] = np.nan
+		self.nFrame += 1
+
+	def store(self, trial):
+		"""Put the per frame metrics of the trial in the trial dictionary, one list per key."""
+		for iKey, key in enumerate(self.keys):
+			trial[key] = np.round(self.data[:self.nFrame, iKey].astype(float), 5).tolist()
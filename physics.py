@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Copyright © 2014, W. van Ham, Radboud University Nijmegen
+This file is part of Sleelab.
+
+Sleelab is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Sleelab is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Sleelab.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Ball physics, without any Qt or OpenGL.
+# Positions and velocities are (nBalls, nDim) float32 arrays in m and m/s,
+# nDim is 2 or 3. The z column of a 2D field is only added for OpenGL.
+# Walls are given as ((xMin, xMax), (yMin, yMax), (zMin, zMax)) in m, in 2D
+# the z walls are ignored.
+
+from __future__ import print_function
+import numpy as np
+
+class BallState(object):
+	"""
+	Positions, velocities and colors of the balls in fixed capacity float32
+	buffers, plus work buffers for the motion kernels. state, p, v, work,
+	color and p3 are contiguous views on the first n balls. They are
+	updated in place only, so nothing is allocated per frame, and resize()
+	only reallocates when a trial has more balls than ever before.
+	p3 are the positions with a z column, for OpenGL. In 2D its z column is
+	always zero.
+	"""
+	def __init__(self, nDim=3, capacity=64):
+		self.nDim = nDim
+		self.capacity = 0
+		self.resize(0, capacity)
+
+	def resize(self, n, capacity=None):
+		"""Use the first n balls, grow the buffers if needed. Contents are not preserved."""
+		if capacity is None:
+			capacity = self.capacity
+		d = self.nDim
+		if max(n, capacity) > self.capacity:
+			self.capacity = max(n, capacity, 2*self.capacity)
+			self._state = np.zeros(2*self.capacity*d, dtype=np.float32) # positions and velocities
+			self._work  = np.zeros(4*self.capacity*d, dtype=np.float32)
+			self._color = np.ones((self.capacity, 3), dtype=np.float32)
+			self._p3    = np.zeros((self.capacity, 3), dtype=np.float32)
+		self.n = n
+		self.state = self._state[:2*n*d].reshape(2, n, d) # m and m/s
+		self.p     = self.state[0]                        # m
+		self.v     = self.state[1]                        # m/s
+		self.work  = self._work[:4*n*d].reshape(4, n, d)
+		self.color = self._color[:n]
+		self.p3    = self._p3[:n]                         # m
+
+def reflectWalls(p, v, wall, work=None):
+	"""
+	Reflect positions p and velocities v in place against the walls.
+	The reflection is done by folding the position into the box, so a ball
+	that moved more than a box width in one step bounces as often as needed
+	and always ends up between the walls. The cost does not depend on the
+	number of balls that bounce. work is an optional (4,)+p.shape buffer, to
+	avoid allocation.
+	"""
+	if work is None:
+		work = np.empty((4,)+p.shape, dtype=p.dtype)
+	q, k, lo, width = work
+	wall = np.asarray(wall, dtype=p.dtype)[:p.shape[1]]
+	np.copyto(lo, wall[:,0])           # ufuncs that broadcast allocate, copyto does not
+	np.copyto(width, wall[:,1] - wall[:,0])
+	np.subtract(p, lo, out=q)
+	q /= width                         # position in box widths
+	np.floor(q, out=k)                 # number of walls passed
+	q -= k                             # position in the box, 0 -- 1
+	np.remainder(k, 2, out=k)          # odd number of bounces: mirrored and reversed
+	np.multiply(k, -2, out=k)
+	k += 1                             # -1 if mirrored, 1 otherwise
+	q -= 0.5
+	q *= k
+	q += 0.5
+	np.multiply(q, width, out=p)
+	p += lo
+	v *= k
+
+def _neighbourOffsets(nDim):
+	"""
+	Cell offsets of half the neighbourhood of a cell (including the cell
+	itself), so that every pair of neighbouring cells is visited once.
+	"""
+	grid = np.indices((3,)*nDim).reshape(nDim, -1).T - 1
+	# keep offsets that are lexicographically >= 0, last dimension most significant
+	keep = [tuple(o[::-1]) >= (0,)*nDim for o in grid]
+	return grid[np.array(keep)]
+
+def contacts(p, r):
+	"""
+	Return index arrays (i, j), i<j, of all pairs of balls with radius r at
+	positions p that overlap. A uniform grid with cells of one ball diameter
+	is used as broad phase, so only balls in neighbouring cells are compared
+	and the cost grows with the number of balls rather than its square.
+	"""
+	n, nDim = p.shape
+	if n < 2:
+		return np.zeros(0, int), np.zeros(0, int)
+	d = 2*r
+	cell = np.floor((p - p.min(0))/d).astype(np.int64) + 1  # one empty cell of padding on each side
+	dims = cell.max(0) + 2
+	strides = np.cumprod(np.hstack(([1], dims[:-1])))
+	key = cell.dot(strides)
+	order = np.argsort(key, kind='mergesort')
+	sortedKey = key[order]
+	iList = []
+	jList = []
+	for offset in _neighbourOffsets(nDim):
+		neighbourKey = key + offset.dot(strides)
+		start = np.searchsorted(sortedKey, neighbourKey, 'left')
+		count = np.searchsorted(sortedKey, neighbourKey, 'right') - start
+		total = count.sum()
+		if total == 0:
+			continue
+		i = np.repeat(np.arange(n), count)
+		first = np.cumsum(count) - count         # position of the first candidate of each ball
+		j = order[np.arange(total) - np.repeat(first - start, count)]
+		if not offset.any():
+			keep = i < j                         # same cell, visit each pair once
+			i = i[keep]
+			j = j[keep]
+		iList.append(i)
+		jList.append(j)
+	if not iList:
+		return np.zeros(0, int), np.zeros(0, int)
+	i = np.hstack(iList)
+	j = np.hstack(jList)
+	# narrow phase
+	dp = p[j] - p[i]
+	overlap = np.einsum('ij,ij->i', dp, dp) < d*d
+	i = i[overlap]
+	j = j[overlap]
+	return np.minimum(i, j), np.maximum(i, j)
+
+def collideBalls(p, v, r):
+	"""
+	Elastic collisions between equal balls with radius r, in place. For each
+	overlapping pair that is approaching the velocity components along the
+	line of centres are exchanged and the balls are pushed apart until they
+	touch. Pairs that share no ball are resolved at once, if a ball touches
+	more than one other ball all pairs are resolved one after the other, so
+	that the kinetic energy is conserved. Returns the number of colliding
+	pairs.
+	"""
+	i, j = contacts(p, r)
+	if len(i) == 0:
+		return 0
+	if np.bincount(np.hstack((i, j))).max() > 1:
+		for iPair in range(len(i)):
+			_collidePairs(p, v, r, i[iPair:iPair+1], j[iPair:iPair+1])
+	else:
+		_collidePairs(p, v, r, i, j)
+	return len(i)
+
+def _collidePairs(p, v, r, i, j):
+	"""Collide the pairs (i, j), no ball may be in more than one pair."""
+	dp = p[j] - p[i]
+	distance = np.sqrt(np.einsum('ij,ij->i', dp, dp))
+	distance[distance == 0] = 1e-12
+	normal = dp/distance[:,None]
+	vNormal = np.einsum('ij,ij->i', v[j] - v[i], normal)   # negative when approaching
+	dv = normal*np.minimum(vNormal, 0)[:,None]
+	v[i] += dv
+	v[j] -= dv
+	dx = normal*(0.5*(2*r - distance))[:,None]
+	p[i] -= dx
+	p[j] += dx
+
+def placeBalls(n, r, wall, nDim=3, rng=np.random, nCandidate=64, maxRound=100):
+	"""
+	Draw n non overlapping positions for balls with radius r, uniformly
+	between the walls. All balls are drawn at once, after which only the
+	balls that overlap another ball are redrawn (dart throwing): each of them
+	gets nCandidate candidate positions and takes the first one that is free.
+	Returns an (n, nDim) array. Raises ValueError if the balls do not fit
+	after maxRound rounds, so this never takes more than bounded time.
+	"""
+	wall = np.asarray(wall, dtype=np.float32)[:nDim]
+	p = rng.uniform(wall[:,0], wall[:,1], (n, nDim)).astype(np.float32)
+	d2 = (2*r)**2
+	for iRound in range(maxRound):
+		i, j = contacts(p, r)
+		if len(i) == 0:
+			return p
+		for iBall in np.unique(j):  # keep the first ball of each overlapping pair
+			candidates = rng.uniform(wall[:,0], wall[:,1], (nCandidate, nDim)).astype(np.float32)
+			others = np.delete(p, iBall, 0)
+			dp = candidates[:,None,:] - others[None,:,:]
+			free = (np.einsum('ijk,ijk->ij', dp, dp) >= d2).all(1)
+			p[iBall] = candidates[np.argmax(free)]  # first free candidate, or retry next round
+	raise ValueError("could not place {} balls with radius {} between walls {}".format(n, r, wall.tolist()))
+
+def sampleVelocities(n, speed, nDim=3, rng=np.random):
+	"""
+	Velocities with the given speed in uniformly distributed directions (see
+	sampling_test.py), an (n, nDim) array. In 2D the z-component of the 3D
+	direction is dropped.
+	"""
+	angles = rng.uniform(0, 1, (n, 2)).astype(np.float32)
+	theta  = 2*np.pi*angles[:,0]
+	phi    = np.arccos(2*angles[:,1]-1)
+	v = np.zeros((n, nDim), dtype=np.float32)
+	v[:,0] = np.cos(theta)*np.sin(phi)*speed # m/s x
+	v[:,1] = np.sin(theta)*np.sin(phi)*speed # m/s y
+	if nDim == 3:
+		v[:,2] = np.cos(phi)*speed           # m/s z
+	return v
+
+def stepConstantVelocity(p, v, dt, wall=None, r=None, work=None):
+	"""
+	Move balls with constant velocity for dt seconds, in place. Balls bounce
+	off each other if r is given and off the walls if wall is given. work
+	is an optional buffer, see reflectWalls.
+	"""
+	if work is None:
+		p += v*dt
+	else:
+		np.multiply(v, dt, out=work[0])
+		p += work[0]
+	if r is not None:
+		collideBalls(p, v, r)
+	if wall is not None:
+		reflectWalls(p, v, wall, work)
+
+def _expm(m):
+	"""Matrix exponential of a small matrix (scaling and squaring of the Taylor series)."""
+	norm = np.abs(m).sum(1).max()
+	nSquare = int(max(0, np.ceil(np.log2(norm))+1)) if norm > 0 else 0
+	m = m/2.0**nSquare
+	term = np.eye(len(m))
+	result = np.eye(len(m))
+	for i in range(1, 20):
+		term = term.dot(m)/i
+		result += term
+	for i in range(nSquare):
+		result = result.dot(result)
+	return result
+
+class VirtualSpring(object):
+	"""
+	Damped random walk around the origin, each coordinate an independent
+	Ornstein-Uhlenbeck process on position and velocity:
+	  dp = v dt
+	  dv = -k p dt - c v dt + s dW
+	with stationary standard deviations sigX (m) and sigV (m/s) and damping
+	c (1/s). The exact discretization for the time step dt is used, so the
+	motion has the same statistics at any frame rate. Coefficients are
+	calculated once and the noise is drawn in blocks of nBlock frames.
+	The defaults correspond to the original per frame model at 120 Hz
+	(sigV=0.005 m/frame, dampening L=0.9 per frame).
+	"""
+	def __init__(self, dt, sigX=0.3, sigV=0.6, damping=-120*np.log(0.9), rng=np.random, nBlock=256):
+		k = (sigV/sigX)**2
+		a = _expm(np.array([[0.0, 1.0], [-k, -damping]])*dt)  # state transition
+		stationary = np.diag([sigX**2, sigV**2])
+		q = stationary - a.dot(stationary).dot(a.T)            # noise covariance per step
+		self.a = a.astype(np.float32)
+		self.l = np.linalg.cholesky(q)
+		self.rng = rng
+		self.nBlock = nBlock
+		self.noise = np.zeros((0,))
+		self.iNoise = 0
+		self.xNew = np.zeros((0,))
+
+	def nextNoise(self, shape):
+		"""Return the correlated (position, velocity) noise of the next frame, shape (2,)+shape."""
+		if self.iNoise >= len(self.noise) or self.noise.shape[2:] != shape:
+			z = self.rng.standard_normal((self.nBlock, 2)+shape)
+			self.noise = np.empty(z.shape, dtype=np.float32)
+			self.noise[:,0] = self.l[0,0]*z[:,0]
+			self.noise[:,1] = self.l[1,0]*z[:,0] + self.l[1,1]*z[:,1]
+			self.iNoise = 0
+		self.iNoise += 1
+		return self.noise[self.iNoise-1]
+
+	def step(self, x):
+		"""
+		Advance the contiguous state x one time step, in place. x[0] are the
+		positions (m), x[1] the velocities (m/s).
+		"""
+		noise = self.nextNoise(x.shape[1:])
+		if self.xNew.shape != x.shape:
+			self.xNew = np.empty(x.shape, dtype=np.float32)
+		np.dot(self.a, x.reshape(2, -1), out=self.xNew.reshape(2, -1))
+		np.add(self.xNew, noise, out=x)
+
+class Engine(object):
+	"""
+	Motion of a field of balls, the physics of Field without Qt or OpenGL.
+	The settings have the same names and meaning as the Field attributes.
+	Call initialize() to place the balls and step() to advance one frame.
+	"""
+	def __init__(self, moveType="virtualSpring", dimType="2D", rBalls=.04,
+			wall=((-0.32, 0.32), (-0.32, 0.32), (-0.32, 0.32)), fFrame=120.0,
+			ballCollide=False, wallCollide=True, rng=np.random):
+		if moveType not in ("ConstantVelocity", "virtualSpring"):
+			raise ValueError("moveType not recognized: {}".format(moveType))
+		self.moveType = moveType
+		self.nDim = 3 if dimType=="3D" else 2
+		self.rBalls = rBalls
+		self.wall = np.array(wall, dtype=np.float32)[:self.nDim]
+		self.fFrame = fFrame
+		self.ballCollide = ballCollide
+		self.wallCollide = wallCollide
+		self.rng = rng
+		self.spring = VirtualSpring(1.0/fFrame, rng=rng)
+		self.balls = BallState(self.nDim)
+
+	def initialize(self, nBalls, sBalls):
+		"""Place nBalls non overlapping balls at rest, or with speed sBalls (m/s) in ConstantVelocity mode."""
+		b = self.balls
+		b.resize(nBalls)
+		b.p[...] = placeBalls(nBalls, self.rBalls, self.wall, self.nDim, self.rng)
+		if self.moveType=="ConstantVelocity":
+			b.v[...] = sampleVelocities(nBalls, sBalls, self.nDim, self.rng)
+		else:
+			b.v[...] = 0
+		self.p = b.p
+		self.v = b.v
+
+	def step(self):
+		"""Advance one frame, in place."""
+		b = self.balls
+		r = self.rBalls if self.ballCollide else None
+		if self.moveType=="ConstantVelocity":
+			wall = self.wall if self.wallCollide else None
+			stepConstantVelocity(b.p, b.v, 1.0/self.fFrame, wall, r, b.work)
+		else:
+			self.spring.step(b.state)
+			if r is not None:
+				collideBalls(b.p, b.v, r)
+
+	def trajectory(self, nFrame):
+		"""
+		Return the positions of nFrame frames as an (nFrame, nBalls, nDim)
+		float32 array. Frame 0 is the current position.
+		"""
+		positions = np.empty((nFrame,)+self.p.shape, dtype=np.float32)
+		positions[0] = self.p
+		for iFrame in range(1, nFrame):
+			self.step()
+			positions[iFrame] = self.p
+		return positions
@@ -0,0 +1,92 @@
+'''
+Tests of the ball physics kernels against brute force versions, run with:
+  python -m pytest physics_test.py
+'''
+
+import numpy as np
+import pytest
+import physics
+
+wall = ((-0.32, 0.32), (-0.32, 0.32), (-0.32, 0.32))
+
+def bruteContacts(p, r):
+	"""All overlapping pairs i<j, by comparing every pair."""
+	i, j = np.triu_indices(len(p), 1)
+	dp = p[j] - p[i]
+	overlap = (dp*dp).sum(1) < (2*r)**2
+	return set(zip(i[overlap].tolist(), j[overlap].tolist()))
+
+@pytest.mark.parametrize("nDim", [2, 3])
+@pytest.mark.parametrize("n, r", [(0, 0.04), (1, 0.04), (50, 0.04), (200, 0.04), (200, 0.1), (30, 0.3)])
+def test_contacts(nDim, n, r):
+	rng = np.random.RandomState(n)
+	p = rng.uniform(-0.32, 0.32, (n, nDim)).astype(np.float32)
+	i, j = physics.contacts(p, r)
+	assert (i < j).all()
+	pairs = set(zip(i.tolist(), j.tolist()))
+	assert len(pairs) == len(i) # every pair once
+	assert pairs == bruteContacts(p, r)
+
+@pytest.mark.parametrize("nDim", [2, 3])
+def test_contactsClustered(nDim):
+	"""Balls on top of each other and on cell boundaries."""
+	p = np.zeros((10, nDim), dtype=np.float32)
+	p[5:, 0] = np.arange(5)*0.08
+	assert set(zip(*[a.tolist() for a in physics.contacts(p, 0.04)])) == bruteContacts(p, 0.04)
+
+@pytest.mark.parametrize("nDim", [2, 3])
+def test_reflectWalls(nDim):
+	rng = np.random.RandomState(1)
+	p = rng.uniform(-3, 3, (1000, nDim)).astype(np.float32) # up to several box widths outside
+	v = rng.uniform(-1, 1, (1000, nDim)).astype(np.float32)
+	speed = np.abs(v).copy()
+	inside = (np.abs(p) <= 0.32).all(1)
+	pInside = p[inside].copy()
+	physics.reflectWalls(p, v, wall)
+	w = np.array(wall, dtype=np.float32)[:nDim]
+	assert (p >= w[:,0] - 1e-6).all() and (p <= w[:,1] + 1e-6).all()
+	assert np.allclose(np.abs(v), speed)
+	assert np.allclose(p[inside], pInside, atol=1e-6) # balls between the walls do not move
+
+@pytest.mark.parametrize("nDim", [2, 3])
+def test_placeBalls(nDim):
+	r = 0.04
+	p = physics.placeBalls(40, r, wall, nDim, np.random.RandomState(2))
+	assert p.shape == (40, nDim)
+	w = np.array(wall, dtype=np.float32)[:nDim]
+	assert (p >= w[:,0]).all() and (p <= w[:,1]).all()
+	i, j = np.triu_indices(len(p), 1)
+	assert np.sqrt(((p[j] - p[i])**2).sum(1)).min() >= 2*r*(1 - 1e-6)
+
+def test_placeBallsTooMany():
+	with pytest.raises(ValueError):
+		physics.placeBalls(200, 0.1, wall, 2, np.random.RandomState(3), maxRound=5)
+
+@pytest.mark.parametrize("nDim", [2, 3])
+def test_collideBallsEnergy(nDim):
+	"""Kinetic energy of colliding balls between walls is conserved."""
+	rng = np.random.RandomState(4)
+	r = 0.04
+	p = physics.placeBalls(20, r, wall, nDim, rng)
+	v = physics.sampleVelocities(20, 1.0, nDim, rng)
+	energy = (v.astype(float)**2).sum()
+	nCollision = 0
+	for iStep in range(2000):
+		p += v/120.0
+		nCollision += physics.collideBalls(p, v, r)
+		physics.reflectWalls(p, v, wall)
+	assert nCollision > 0
+	assert abs((v.astype(float)**2).sum()/energy - 1) < 1e-4
+
+@pytest.mark.parametrize("fFrame", [60.0, 120.0, 144.0])
+def test_virtualSpringStationary(fFrame):
+	"""Position and velocity spread of the virtual spring do not depend on the frame rate."""
+	rng = np.random.RandomState(5)
+	spring = physics.VirtualSpring(1.0/fFrame, rng=rng)
+	x = np.empty((2, 2000, 2), dtype=np.float32) # start in the stationary distribution
+	x[0] = rng.normal(0, 0.3, x.shape[1:])
+	x[1] = rng.normal(0, 0.6, x.shape[1:])
+	for iStep in range(int(5*fFrame)): # 5 s
+		spring.step(x)
+	assert abs(x[0].std()/0.3 - 1) < 0.05
+	assert abs(x[1].std()/0.6 - 1) < 0.05
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Copyright © 2014, W. van Ham, Radboud University Nijmegen
+This file is part of Sleelab.
+
+Sleelab is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Sleelab is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Sleelab.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Binary recording of the displayed ball positions of every frame of every
+# trial. The frame loop only copies the positions into a preallocated ring
+# buffer, a worker thread writes them to disk in bulk.
+# File format, little endian:
+#   file header   fileHeader: magic, version, nTrial, indexOffset
+#   per trial     trialHeader: magic, iTrial, iCondition, nBalls, nDim, nFrame, tStart (s, time.time())
+#                 nFrame records of frameDtype(nBalls, nDim): t (s since tStart), p (nBalls, nDim)
+#   at the end    nTrial entries of indexDtype, at indexOffset
+# indexOffset and the nFrame of each trial are filled in when they are known,
+# a file that was not closed has indexOffset 0 and can still be read by
+# walking the trial headers. Every bulk write is flushed, so at most the last
+# quarter second of a trial that was not ended is missing.
+# Recording reads a file memory mapped, so that any frames of any trial can be
+# read without reading the rest. Text files of the old
+# {"TrialData": [[t, x, y, z, ...], ...]} format can be converted with:
+#   python recording.py motSub3.txt
+
+from __future__ import print_function
+import sys, os, time, struct, threading, collections, logging, argparse, numpy as np
+
+magic = b'SLEDREC\0'
+version = 1
+fileHeader = struct.Struct('<8sIIQ')        # magic, version, nTrial, indexOffset
+trialMagic = b'TRL\0'
+trialHeader = struct.Struct('<4sIIIIId')    # magic, iTrial, iCondition, nBalls, nDim, nFrame, tStart
+indexDtype = np.dtype([('offset', '<u8'), ('iTrial', '<u4'), ('iCondition', '<u4'),
+	('nBalls', '<u4'), ('nDim', '<u4'), ('nFrame', '<u4'), ('tStart', '<f8')])
+
+def frameDtype(nBalls, nDim=3):
+	"""One frame record: time and positions."""
+	return np.dtype([('t', '<f8'), ('p', '<f4', (nBalls, nDim))])
+
+class Recorder(object):
+	"""
+	Call startTrial() at the start of a trial, record() every frame,
+	endTrial() at the end and close() when done. All are called from the
+	frame loop and do not wait for the disk, unless a trial has more balls
+	than any trial before it. capacity frames fit in the ring buffer,
+	frames that do not fit because the writer is behind are dropped.
+	"""
+	def __init__(self, fileName, capacity=4096, nDim=3):
+		self.fileName = fileName
+		self.capacity = capacity
+		self.nDim = nDim
+		self.times = np.zeros(capacity)
+		self.positions = np.zeros((capacity, 0, nDim), dtype=np.float32)
+		self.nBalls = 0
+		self.head = 0     # number of frames ever recorded, only changed by the frame loop
+		self.tail = 0     # number of frames ever written, only changed by the writer
+		self.nDropped = 0
+		self.commands = collections.deque() # (head, function, arguments), run by the writer after the frames before head
+		self.condition = threading.Condition()
+		self.index = []
+		self.error = None # exception that stopped the writer, nothing is written after it
+
+		self.file = open(fileName, 'wb')
+		self.file.write(fileHeader.pack(magic, version, 0, 0))
+		self.thread = threading.Thread(target=self.write, name="recorder")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def startTrial(self, iTrial, iCondition, nBalls):
+		"""Start a trial of nBalls balls, the times of record() are relative to now."""
+		if nBalls > self.positions.shape[1]:
+			self.flush() # the writer must be done with the ring buffer before it is replaced
+			self.positions = np.zeros((self.capacity, nBalls, self.nDim), dtype=np.float32)
+		self.nBalls = nBalls
+		self.tStart = time.time()
+		self.command(self.writeTrialHeader, iTrial, iCondition, nBalls, self.tStart)
+
+	def record(self, t, p):
+		"""Record positions p, (nBalls, nDim), at t s since the start of the trial."""
+		if self.head - self.tail >= self.capacity:
+			self.nDropped += 1
+			return
+		i = self.head % self.capacity
+		self.times[i] = t
+		self.positions[i, :self.nBalls] = p
+		self.head += 1
+		if self.head % 64 == 0: # wake up the writer now and then
+			with self.condition:
+				self.condition.notify()
+
+	def endTrial(self):
+		self.command(self.writeTrialEnd)
+		if self.nDropped:
+			logging.warning("recorder dropped {} frames".format(self.nDropped))
+			self.nDropped = 0
+
+	def flush(self):
+		"""Wait until everything recorded so far is written."""
+		event = threading.Event()
+		self.command(event.set)
+		while not event.wait(0.1):
+			if not self.thread.is_alive():
+				return # the writer stopped, error is logged
+
+	def close(self):
+		"""Write the rest, the index and the file header, and stop the writer."""
+		self.command(self.writeIndex)
+		self.command(None)
+		self.thread.join()
+		try:
+			self.file.close()
+		except (IOError, OSError) as e:
+			logging.error("could not close {}: {}".format(self.fileName, e))
+
+	def command(self, function, *arguments):
+		if self.error is not None:
+			return
+		with self.condition:
+			self.commands.append((self.head, function, arguments))
+			self.condition.notify()
+
+	def write(self):
+		"""worker thread function"""
+		try:
+			self.writeLoop()
+		except Exception as e: # disk full and such, the experiment goes on without recording
+			self.error = e
+			logging.error("recorder stopped, {} is incomplete: {}".format(self.fileName, e))
+
+	def writeLoop(self):
+		while True:
+			with self.condition:
+				if not self.commands and self.head - self.tail < 64:
+					self.condition.wait(0.25)
+				command = self.commands.popleft() if self.commands else None
+				head = command[0] if command else self.head
+			self.writeFrames(head)
+			if command is None:
+				continue # woke up for frames only
+			head, function, arguments = command
+			if function is None:
+				break
+			function(*arguments)
+
+	def writeFrames(self, head):
+		"""Write the frames from tail up to head in at most two bulk writes."""
+		while self.tail < head:
+			i = self.tail % self.capacity
+			n = min(head - self.tail, self.capacity - i)
+			nBalls = int(self.index[-1]['nBalls'])
+			frames = np.empty(n, dtype=frameDtype(nBalls, self.nDim))
+			frames['t'] = self.times[i:i+n]
+			frames['p'] = self.positions[i:i+n, :nBalls]
+			self.file.write(frames.tobytes())
+			self.index[-1]['nFrame'] += n
+			self.tail += n
+		self.file.flush()
+
+	def writeTrialHeader(self, iTrial, iCondition, nBalls, tStart):
+		entry = np.zeros((), dtype=indexDtype)
+		entry['offset'] = self.file.tell()
+		entry['iTrial'], entry['iCondition'], entry['nBalls'], entry['nDim'], entry['tStart'] = iTrial, iCondition, nBalls, self.nDim, tStart
+		self.index.append(entry)
+		self.file.write(trialHeader.pack(trialMagic, iTrial, iCondition, nBalls, self.nDim, 0, tStart))
+
+	def writeTrialEnd(self):
+		"""Fill in the number of frames of the trial."""
+		entry = self.index[-1]
+		end = self.file.tell()
+		self.file.seek(int(entry['offset']))
+		self.file.write(trialHeader.pack(trialMagic, int(entry['iTrial']), int(entry['iCondition']),
+			int(entry['nBalls']), int(entry['nDim']), int(entry['nFrame']), float(entry['tStart'])))
+		self.file.seek(end)
+		self.file.flush()
+
+	def writeIndex(self):
+		indexOffset = self.file.tell()
+		self.file.write(np.array(self.index, dtype=indexDtype).tobytes())
+		self.file.seek(0)
+		self.file.write(fileHeader.pack(magic, version, len(self.index), indexOffset))
+		self.file.seek(0, os.SEEK_END)
+
+def writeFile(fileName, trials, nDim=3):
+	"""
+	Write trials, an iterable of (iTrial, iCondition, tStart, times, positions)
+	with positions (nFrame, nBalls, nDim), to a new file at once.
+	"""
+	index = []
+	with open(fileName, 'wb') as f:
+		f.write(fileHeader.pack(magic, version, 0, 0))
+		for iTrial, iCondition, tStart, times, positions in trials:
+			nFrame, nBalls = positions.shape[:2]
+			index.append((f.tell(), iTrial, iCondition, nBalls, nDim, nFrame, tStart))
+			f.write(trialHeader.pack(trialMagic, iTrial, iCondition, nBalls, nDim, nFrame, tStart))
+			frames = np.empty(nFrame, dtype=frameDtype(nBalls, nDim))
+			frames['t'] = times
+			frames['p'] = positions
+			f.write(frames.tobytes())
+		indexOffset = f.tell()
+		f.write(np.array(index, dtype=indexDtype).tobytes())
+		f.seek(0)
+		f.write(fileHeader.pack(magic, version, len(index), indexOffset))
+
+class Recording(object):
+	"""
+	A recorded file, memory mapped. index has one entry of indexDtype per
+	trial, trials are numbered in the order of the file (k), which is not
+	necessarily their iTrial.
+	"""
+	def __init__(self, fileName):
+		self.fileName = fileName
+		self.data = np.memmap(fileName, dtype=np.uint8, mode='r')
+		fileMagic, fileVersion, nTrial, indexOffset = fileHeader.unpack_from(self.data, 0)
+		if fileMagic != magic:
+			raise ValueError("not a recording: {}".format(fileName))
+		if fileVersion > version:
+			raise ValueError("recording version {} not supported: {}".format(fileVersion, fileName))
+		if indexOffset:
+			self.index = np.ndarray(nTrial, dtype=indexDtype, buffer=self.data, offset=indexOffset)
+		else:
+			logging.warning("recording was not closed, reading trial headers: {}".format(fileName))
+			self.index = self.walk()
+
+	def walk(self):
+		"""Index of a file without one, made from the trial headers."""
+		index = []
+		offset = fileHeader.size
+		while offset + trialHeader.size <= len(self.data):
+			trialMagic_, iTrial, iCondition, nBalls, nDim, nFrame, tStart = trialHeader.unpack_from(self.data, offset)
+			if trialMagic_ != trialMagic:
+				break
+			size = frameDtype(nBalls, nDim).itemsize
+			nFrameMax = (len(self.data) - offset - trialHeader.size) // size
+			if nFrame == 0 or nFrame > nFrameMax: # trial was not ended
+				nFrame = nFrameMax
+			index.append((offset, iTrial, iCondition, nBalls, nDim, nFrame, tStart))
+			offset += trialHeader.size + nFrame*size
+		return np.array(index, dtype=indexDtype)
+
+	def __len__(self):
+		return len(self.index)
+
+	def frames(self, k):
+		"""Frame records of the k'th trial, memory mapped, fields t and p."""
+		entry = self.index[k]
+		return np.ndarray(int(entry['nFrame']), dtype=frameDtype(int(entry['nBalls']), int(entry['nDim'])),
+			buffer=self.data, offset=int(entry['offset']) + trialHeader.size)
+
+	def times(self, k, a=None, b=None):
+		"""Times of frames a up to b of the k'th trial, s since its start."""
+		return self.frames(k)['t'][a:b]
+
+	def positions(self, k, a=None, b=None):
+		"""Positions of frames a up to b of the k'th trial, (nFrame, nBalls, nDim), memory mapped."""
+		return self.frames(k)['p'][a:b]
+
+def readText(fileName, nDim=3):
+	"""
+	Trials of an old text file, one by one as for writeFile(). Trial numbers
+	are the order in the file, conditions and start times are not known.
+	"""
+	iTrial = 0
+	rows = []
+	with open(fileName) as f:
+		for line in f:
+			line = line.strip()
+			if line.startswith('{"TrialData'):
+				rows = []
+			elif line.startswith(']}'):
+				if rows:
+					data = np.array(rows)
+					yield iTrial, 0, float('nan'), data[:,0], data[:,1:].reshape(len(data), -1, nDim)
+				iTrial += 1
+			elif line.startswith('['):
+				rows.append([float(x) for x in line.strip('[],').split(',')])
+	if rows and line and not line.startswith(']}'): # trial that was not ended
+		data = np.array(rows)
+		yield iTrial, 0, float('nan'), data[:,0], data[:,1:].reshape(len(data), -1, nDim)
+
+def main():
+	logging.basicConfig(level=logging.INFO)
+	parser = argparse.ArgumentParser(description="Convert a trajectory text file to a recording, or show the trials in a recording.")
+	parser.add_argument("fileName", help="text file (.txt) to convert, or recording (.rec) to show")
+	parser.add_argument("-o", "--output", help="recording to write, defaults to the text file name with .rec")
+	parser.add_argument("--nDim", type=int, default=3, help="number of coordinates per ball in the text file")
+	args = parser.parse_args()
+
+	with open(args.fileName, 'rb') as f:
+		isRecording = f.read(len(magic)) == magic
+	if isRecording:
+		recording = Recording(args.fileName)
+		for k, entry in enumerate(recording.index):
+			print("{:4d}: trial {:4d}, condition {:3d}, {:3d} balls, {:5d} frames".format(
+				k, entry['iTrial'], entry['iCondition'], entry['nBalls'], entry['nFrame']))
+	else:
+		output = args.output or os.path.splitext(args.fileName.strip())[0] + ".rec"
+		writeFile(output, readText(args.fileName, args.nDim), args.nDim)
+		logging.info("converted {} to {} with {} trials".format(args.fileName, output, len(Recording(output))))
+
+if __name__ == '__main__':
+	main()
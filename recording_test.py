@@ -0,0 +1,99 @@
+'''
+Tests of the binary recordings of the ball positions, run with:
+  python -m pytest recording_test.py
+'''
+
+import shutil
+import numpy as np
+import pytest
+import recording
+
+def record(recorder, iTrial, nBalls, nFrame, nDim, end=True):
+	"""Record nFrame frames of nBalls balls, return the times and positions."""
+	times = np.arange(nFrame)/60.0
+	positions = np.random.RandomState(iTrial).uniform(-0.3, 0.3, (nFrame, nBalls, nDim)).astype(np.float32)
+	recorder.startTrial(iTrial, 10+iTrial, nBalls)
+	for t, p in zip(times, positions):
+		recorder.record(t, p)
+	if end:
+		recorder.endTrial()
+	return times, positions
+
+@pytest.mark.parametrize("nDim", [2, 3])
+def test_roundTrip(tmpdir, nDim):
+	"""Trials of different numbers of balls that wrap around the ring buffer."""
+	fileName = str(tmpdir.join("balls.rec"))
+	recorder = recording.Recorder(fileName, capacity=256, nDim=nDim)
+	trials = []
+	for iTrial, (nBalls, nFrame) in enumerate([(5, 100), (20, 200), (10, 150)]):
+		trials.append(record(recorder, iTrial, nBalls, nFrame, nDim))
+		recorder.flush() # time between trials, so that no frames are dropped
+	recorder.close()
+	assert recorder.error is None
+
+	r = recording.Recording(fileName)
+	assert len(r) == len(trials)
+	for k, (times, positions) in enumerate(trials):
+		entry = r.index[k]
+		assert (entry['iTrial'], entry['iCondition'], entry['nDim']) == (k, 10+k, nDim)
+		assert entry['nBalls'] == positions.shape[1]
+		assert entry['nFrame'] == len(times)
+		assert np.array_equal(r.times(k), times)
+		assert np.array_equal(r.positions(k), positions)
+		assert np.array_equal(r.positions(k, 10, 20), positions[10:20])
+
+def test_notClosed(tmpdir):
+	"""A file that was not closed, with a trial that was not ended and a frame cut in half."""
+	fileName = str(tmpdir.join("balls.rec"))
+	copyName = str(tmpdir.join("copy.rec"))
+	recorder = recording.Recorder(fileName, nDim=2)
+	times0, positions0 = record(recorder, 0, 8, 50, 2)
+	times1, positions1 = record(recorder, 1, 8, 30, 2, end=False)
+	recorder.flush()
+	shutil.copy(fileName, copyName)
+	recorder.close()
+	size = recording.frameDtype(8, 2).itemsize
+	with open(copyName, 'r+b') as f:
+		f.seek(0, 2)
+		f.truncate(f.tell() - size//2)
+
+	r = recording.Recording(copyName)
+	assert len(r) == 2
+	assert list(r.index['nFrame']) == [50, 29]
+	assert np.array_equal(r.positions(0), positions0)
+	assert np.array_equal(r.times(1), times1[:29])
+	assert np.array_equal(r.positions(1), positions1[:29])
+
+def test_notRecording(tmpdir):
+	fileName = str(tmpdir.join("balls.txt"))
+	with open(fileName, 'wb') as f:
+		f.write(b'{"TrialData": [\n' + b'\0'*64)
+	with pytest.raises(ValueError):
+		recording.Recording(fileName)
+
+def test_readText(tmpdir):
+	"""Conversion of the old text format, the last trial was not ended."""
+	rng = np.random.RandomState(1)
+	trials = [rng.uniform(-0.3, 0.3, (nFrame, 1+3*nBalls)) for nFrame, nBalls in [(4, 2), (6, 3), (3, 2)]]
+	textName = str(tmpdir.join("motSub3.txt"))
+	with open(textName, 'w') as f:
+		for i, data in enumerate(trials):
+			f.write('{"TrialData": [\n')
+			for row in data:
+				f.write('[' + ', '.join(repr(float(x)) for x in row) + '],\n')
+			if i < len(trials) - 1:
+				f.write(']}\n')
+
+	converted = list(recording.readText(textName))
+	assert [c[0] for c in converted] == [0, 1, 2]
+	for (iTrial, iCondition, tStart, times, positions), data in zip(converted, trials):
+		assert np.array_equal(times, data[:,0])
+		assert np.array_equal(positions, data[:,1:].reshape(len(data), -1, 3))
+
+	fileName = str(tmpdir.join("motSub3.rec"))
+	recording.writeFile(fileName, recording.readText(textName))
+	r = recording.Recording(fileName)
+	assert list(r.index['nBalls']) == [2, 3, 2]
+	for k, data in enumerate(trials):
+		assert np.array_equal(r.times(k), data[:,0])
+		assert np.allclose(r.positions(k), data[:,1:].reshape(len(data), -1, 3), atol=1e-7)
@@ -18,18 +18,30 @@ You should have received a copy of the GNU General Public License
 along with Sleelab.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-import sys
+import sys, os, struct, hashlib, logging, numpy as np
 
 from OpenGL.GL.shaders import *
 from OpenGL.GL import *
 from OpenGL.GLU import *
 from OpenGL.arrays import vbo
+from OpenGL.error import GLError
 from OpenGL.GL.shaders import *
 
-def initializeShaders(vertexShaderString, fragmentShaderString, geometryShaderString=None):
+def initializeShaders(vertexShaderString, fragmentShaderString, geometryShaderString=None, cacheDirectory=None):
+	"""
+	Compile and link the shaders into a program and use it. With a
+	cacheDirectory the linked program binary is stored there and loaded
+	instead of compiling the next time, if the driver accepts it.
+	"""
 	if not glUseProgram:
 		print ('Missing Shader Objects!')
 		sys.exit(1)
+	if cacheDirectory is not None:
+		fileName = os.path.join(cacheDirectory, programKey(vertexShaderString, fragmentShaderString, geometryShaderString)+".bin")
+		program = loadProgram(fileName)
+		if program is not None:
+			glUseProgram(program)
+			return program
 	try:
 		vertexShader = compileShader(vertexShaderString, GL_VERTEX_SHADER)
 		if geometryShaderString !=None:
@@ -43,47 +55,148 @@ def initializeShaders(vertexShaderString, fragmentShaderString, geometryShaderSt
 		sys.exit(1)
 	try:
 		if geometryShaderString !=None:
-			program = compileProgram(vertexShader, fragmentShader, geometryShader)
+			program = linkProgram((vertexShader, fragmentShader, geometryShader), cacheDirectory is not None)
 		else:
-			program = compileProgram(vertexShader, fragmentShader)
+			program = linkProgram((vertexShader, fragmentShader), cacheDirectory is not None)
 	except RuntimeError as (errorString):
 		print("ERROR: Shader program did not link/validate properly: {}".format(errorString))
 		sys.exit(1)
+	if cacheDirectory is not None:
+		saveProgram(program, fileName)
 	
 	glUseProgram(program)
 	return program
 
+def linkProgram(shaders, retrievable=False):
+	"""
+	Link compiled shaders into a program, like compileProgram(), but with
+	retrievable True the driver is told before linking that the binary
+	will be read back, some drivers (Mesa) give no usable binary otherwise.
+	"""
+	program = glCreateProgram()
+	for shader in shaders:
+		glAttachShader(program, shader)
+	if retrievable and bool(glProgramParameteri):
+		glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+	glLinkProgram(program)
+	if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+		log = glGetProgramInfoLog(program)
+		glDeleteProgram(program)
+		raise RuntimeError(log)
+	for shader in shaders:
+		glDetachShader(program, shader)
+		glDeleteShader(shader)
+	return program
+
+def programKey(*sources):
+	"""Hash of the shader sources and the OpenGL implementation, binaries only work on the same driver."""
+	h = hashlib.sha1()
+	for source in sources:
+		h.update(repr(source).encode('utf-8'))
+	for name in (GL_VENDOR, GL_RENDERER, GL_VERSION):
+		h.update(glGetString(name) or b"")
+	return h.hexdigest()
+
+def programBinarySupported():
+	return bool(glGetProgramBinary) and bool(glProgramBinary) and glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS) > 0
+
+def loadProgram(fileName):
+	"""Program from a binary saved by saveProgram(), None if there is none or the driver rejects it."""
+	if not os.path.exists(fileName) or not programBinarySupported():
+		return None
+	with open(fileName, 'rb') as f:
+		data = f.read()
+	try:
+		binaryFormat, = struct.unpack('<I', data[:4])
+	except struct.error: # truncated file
+		binaryFormat = None
+	binary = np.frombuffer(data[4:], dtype=np.uint8)
+	if binaryFormat is None or len(binary) == 0:
+		logging.warning("shader program binary corrupt, removed: {}".format(fileName))
+		os.remove(fileName)
+		return None
+	program = glCreateProgram()
+	try:
+		glProgramBinary(program, binaryFormat, binary, len(binary))
+		linked = glGetProgramiv(program, GL_LINK_STATUS) == GL_TRUE
+	except GLError:
+		linked = False
+	if not linked: # driver updated, or binary from another GPU
+		logging.info("shader program binary rejected, compiling: {}".format(fileName))
+		glDeleteProgram(program)
+		return None
+	return program
+
+def saveProgram(program, fileName):
+	"""Save the binary of a linked program, if the driver supports that."""
+	if not programBinarySupported():
+		return
+	size = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+	if size <= 0:
+		return
+	length = np.zeros(1, dtype=np.int32)
+	binaryFormat = np.zeros(1, dtype=np.uint32)
+	binary = np.zeros(size, dtype=np.uint8)
+	glGetProgramBinary(program, size, length, binaryFormat, binary)
+	directory = os.path.dirname(fileName)
+	if directory and not os.path.isdir(directory):
+		os.makedirs(directory)
+	tmpName = "{}.{}.tmp".format(fileName, os.getpid())
+	with open(tmpName, 'wb') as f:
+		f.write(struct.pack('<I', int(binaryFormat[0])))
+		f.write(binary[:int(length[0])].tobytes())
+	try:
+		os.rename(tmpName, fileName)
+	except OSError: # MS Windows, another process was first
+		os.remove(tmpName)
+
+positionLocation, offsetLocation, colorLocation = 0, 1, 2 # attribute locations of the ball shaders
+
 vs = \
 """#version 330
 uniform int nFrame;                           // frame number
-uniform mat4 MVP;                             // more like VP really
+uniform mat4 MVP[2];                          // more like VP really, per eye
+uniform int nEye;                             // 2: both eyes side-by-side in one pass, instance 2i+iEye is ball i
+uniform int firstEye;                         // eye if nEye is 1
 
-uniform vec3 offset;                          // offset from vertex coordinate (ball position)
 uniform float rBalls;
+uniform float intensity[2];                   // multiplier for color, per eye
 
-in vec3 position;                             // vertex coordinate
+layout(location = 0) in vec3 position;        // vertex coordinate
+layout(location = 1) in vec3 offset;          // per instance: offset from vertex coordinate (ball position)
+layout(location = 2) in vec3 color;           // per instance: ball color
 out float normal;                             // vertex normal \dot light dir
+out vec3 ballColor;
 
 void main() {
+	int iEye = nEye == 2 ? gl_InstanceID % 2 : firstEye;
 	vec3 lightDirection = vec3(0.0,1.0,1.0);
-	gl_Position = MVP * vec4(position*rBalls+offset, 1.0);
+	gl_Position = MVP[iEye] * vec4(position*rBalls+offset, 1.0);
+	if (nEye == 2) {
+		// squeeze into the left or right half of the viewport and clip at the middle
+		float side = iEye == 0 ? -1.0 : 1.0;
+		gl_Position.x = 0.5*gl_Position.x + 0.5*side*gl_Position.w;
+		gl_ClipDistance[0] = side*gl_Position.x;
+	} else
+		gl_ClipDistance[0] = 1.0;
 	
 	normal = dot(normalize(lightDirection), normalize(position.xyz));
+	ballColor = intensity[iEye]*color;
 }
 """
 
 fs = \
 """#version 330
-uniform vec3 color;
 uniform float diffuse;
 uniform float ambient;
 uniform float fadeFactor;   // multiplyer for color (1.0 for faded in, 0.0 for faded out)
 
 in float normal;
+in vec3 ballColor;
 out vec4 gl_FragColor;
 void main() {
 	if (gl_FrontFacing)
-		gl_FragColor = vec4(max(ambient,diffuse*normal)*color, 1.0);
+		gl_FragColor = vec4(max(ambient,diffuse*normal)*ballColor, 1.0);
 		//gl_FragColor = vec4(max(dot(normal, lightDirection)*diffuse, ambient)*color, 1.0);
 		//gl_FragColor = vec4(color*(ambient+dot(normal, lightDirection)), 1.0);
 		
@@ -92,3 +205,77 @@ void main() {
 
 }
 """
+
+# Sphere impostors: every ball is one quad facing the eye, just large enough to
+# cover the sphere. The fragment shader intersects the ray from the eye with the
+# sphere, discards the misses and writes the depth of the hit. The attribute
+# locations are the same as those of vs, the quad corners come in as position.
+impostorVs = \
+"""#version 330
+uniform mat4 MVP[2];                          // more like VP really, per eye
+uniform vec3 pEye[2];                         // eye positions
+uniform int nEye;                             // 2: both eyes side-by-side in one pass, instance 2i+iEye is ball i
+uniform int firstEye;                         // eye if nEye is 1
+uniform float rBalls;
+uniform float intensity[2];                   // multiplier for color, per eye
+
+layout(location = 0) in vec3 position;        // quad corner, x and y are -1 or 1
+layout(location = 1) in vec3 offset;          // per instance: ball position
+layout(location = 2) in vec3 color;           // per instance: ball color
+out vec3 world;                               // position on the quad
+flat out vec3 center;
+flat out int iEye;
+out vec3 ballColor;
+
+void main() {
+	iEye = nEye == 2 ? gl_InstanceID % 2 : firstEye;
+	vec3 view = offset - pEye[iEye];
+	float d = length(view);
+	vec3 w = view/d;
+	vec3 u = normalize(cross(w, abs(w.y) < 0.99 ? vec3(0.0,1.0,0.0) : vec3(1.0,0.0,0.0)));
+	vec3 v = cross(u, w);
+	float size = rBalls*d/sqrt(max(d*d-rBalls*rBalls, 1e-6)); // radius of the cone around the sphere
+	world = offset + size*(position.x*u + position.y*v);
+	center = offset;
+	ballColor = intensity[iEye]*color;
+	gl_Position = MVP[iEye] * vec4(world, 1.0);
+	if (nEye == 2) {
+		// squeeze into the left or right half of the viewport and clip at the middle
+		float side = iEye == 0 ? -1.0 : 1.0;
+		gl_Position.x = 0.5*gl_Position.x + 0.5*side*gl_Position.w;
+		gl_ClipDistance[0] = side*gl_Position.x;
+	} else
+		gl_ClipDistance[0] = 1.0;
+}
+"""
+
+impostorFs = \
+"""#version 330
+uniform mat4 MVP[2];
+uniform vec3 pEye[2];
+uniform float rBalls;
+uniform float diffuse;
+uniform float ambient;
+
+in vec3 world;
+flat in vec3 center;
+flat in int iEye;
+in vec3 ballColor;
+out vec4 gl_FragColor;
+void main() {
+	vec3 eye = pEye[iEye];
+	vec3 direction = normalize(world - eye);
+	vec3 oc = eye - center;
+	float b = dot(oc, direction);
+	float h = b*b - dot(oc, oc) + rBalls*rBalls;
+	if (h < 0.0)
+		discard;
+	vec3 hit = eye + (-b - sqrt(h))*direction;
+	vec4 clip = MVP[iEye] * vec4(hit, 1.0); // the side-by-side squeeze does not change depth
+	gl_FragDepth = 0.5*gl_DepthRange.diff*clip.z/clip.w + 0.5*(gl_DepthRange.near + gl_DepthRange.far);
+
+	vec3 lightDirection = vec3(0.0,1.0,1.0);
+	float normal = dot(normalize(lightDirection), (hit - center)/rBalls);
+	gl_FragColor = vec4(max(ambient,diffuse*normal)*ballColor, 1.0);
+}
+"""
@@ -19,7 +19,7 @@ along with Sleelab.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from __future__ import print_function
-import logging, signal, argparse, csv, numpy as np
+import logging, signal, argparse, csv, time, numpy as np
 import OpenGL
 OpenGL.ERROR_ON_COPY = True   # make sure we send numpy arrays
 # PyQt (package python-qt4-gl on Ubuntu)
@@ -136,6 +136,23 @@ class Main(QMainWindow):
 		self.nextAction.triggered.connect(self.field.conditions.next)
 		self.nextAction.setEnabled(False)
 
+		# replay of a recorded trial, see --replay
+		self.replayActions = []
+		for name, shortcut, tip, function in (
+				('Play/Pause', 'P', 'Play or pause the replay', lambda: self.field.replayPlay()),
+				('Back', ',', 'Go back one second', lambda: self.field.replaySeek(relative=-1.0)),
+				('Forward', '.', 'Go forward one second', lambda: self.field.replaySeek(relative=1.0)),
+				('Restart', Qt.Key_Home, 'Go to the start of the trial', lambda: self.field.replaySeek(0.0)),
+				('Slower', '[', 'Halve the replay speed', lambda: self.field.replaySetSpeed(factor=0.5)),
+				('Faster', ']', 'Double the replay speed', lambda: self.field.replaySetSpeed(factor=2.0)),
+				('Real time', '=', 'Replay at the recorded speed', lambda: self.field.replaySetSpeed(1.0))):
+			action = QAction(name, self)
+			action.setShortcut(shortcut)
+			action.setStatusTip(tip)
+			action.triggered.connect(function)
+			action.setEnabled(False)
+			self.replayActions.append(action)
+
 		# populate the menu bar
 		menubar = self.menuBar()
 		fileMenu = menubar.addMenu('&File')
@@ -156,6 +173,11 @@ class Main(QMainWindow):
 		experimentMenu.addAction(self.nextAction)
 		experimentMenu.addAction(self.newAction)
 
+		replayMenu = menubar.addMenu('&Replay')
+		for action in self.replayActions:
+			replayMenu.addAction(action)
+			self.addAction(action)
+
 		self.addAction(self.nextAction)
 		self.addAction(self.upAction) #add space action for next
 		self.addAction(self.confirmAction)
@@ -198,24 +220,41 @@ class Main(QMainWindow):
 			self.startAction.setIcon(self.startIcon)
 
 
+	def replay(self, fileName, k=0):
+		"""Show trial k of a recording instead of running the experiment."""
+		try:
+			self.field.startReplay(fileName, k) # before the field is shown, initializeGL must see the replay state
+		except (ValueError, IOError, OSError) as e:
+			logging.error("could not replay: {}".format(e))
+			self.statusBar().showMessage("Could not replay: {}".format(e))
+			return
+		self.startAction.setEnabled(False)
+		self.toggleText(False)
+		for action in self.replayActions:
+			action.setEnabled(True)
+		self.statusBar().showMessage('Replay of trial {} of {}'.format(k, fileName))
+
 	def load(self, event=None, fileName=None):
 		"""Load new list of trials."""
 		if os.path.isdir('data'):
 				directory = 'data/'
-		self.field.filename= os.path.join(directory,"motSub"+str(self.field.subject)+'.txt ') #probably move this when condityion is added
-		self.field.savefile= open(self.field.filename,'w')
+		self.field.openRecording(os.path.join(directory,"motSub"+str(self.field.subject)+'.rec')) #probably move this when condityion is added
 		self.nextAction.setEnabled(False)
 		if fileName==None:
 			fileName = QFileDialog.getOpenFileName(self, "Open file", filter="Experiment file (.csv)(*.csv)")
 		if fileName==None:
 			QMessageBox.question(self, 'Error', "No filename given?", QtGui.QMessageBox.Ok)
 			return
-		#try:
 		self.field.conditions.load(fileName)
-		self.field.initializeObjects()
-		#except Exception as e:
-		#	self.errorMessageDialog.showMessage("Could not read file: {}\n{}".format(fileName, e))
-		#	raise e
+		self.field.session = self.args.session or time.strftime('%Y%m%dT%H%M%S') # new trajectories unless the session is given
+		logging.info("session: {}".format(self.field.session))
+		try:
+			self.field.precomputeTrajectories()
+			self.field.initializeObjects()
+		except ValueError as e: # balls of a condition do not fit between the walls
+			logging.error("could not load {}: {}".format(fileName, e))
+			self.errorMessageDialog.showMessage("Could not load file: {}\n{}".format(fileName, e))
+			return
 			
 		logging.info("load file {} with {} conditions".format(fileName, len(self.field.conditions.conditions)))		
 
@@ -258,6 +297,11 @@ class Main(QMainWindow):
 			self.field.toggleStereo(True, sim=True)
 		if args.stereoIntensity:
 			self.field.stereoIntensity(int(args.stereoIntensity))
+		if args.replay:
+			self.replay(args.replay, args.trial)
+		if args.capture:
+			self.field.captureFormat = args.captureFormat
+			self.field.captureDirectory = args.capture
 
 		
 
@@ -278,6 +322,11 @@ def main():
 	parser.add_argument("--stereoIntensity", help="Stereoscopic intensity balance -9 — 9")
 	parser.add_argument("-r", "--running", help="start in running mode", action="store_true")
 	parser.add_argument("--subject", help="Subject ID")
+	parser.add_argument("--session", help="session ID, the ball trajectories depend on it, defaults to the time the experiment is loaded")
+	parser.add_argument("--replay", help="show a recorded trial (.rec) instead of the experiment")
+	parser.add_argument("--trial", type=int, default=0, help="index of the trial to replay, in the order of the recording")
+	parser.add_argument("--capture", help="write every displayed frame to this directory")
+	parser.add_argument("--captureFormat", help="format of the captured frames", choices=("png", "raw"), default="png")
 	args = parser.parse_args()	
 	
 	# make application and main window
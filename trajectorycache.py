@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Copyright © 2014, W. van Ham, Radboud University Nijmegen
+This file is part of Sleelab.
+
+Sleelab is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Sleelab is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Sleelab.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Disk cache of precomputed ball trajectories.
+# The trajectory of a trial is fully determined by its parameters and a seed
+# (see parameters()). The seed includes a session, so that a subject who does
+# the experiment again gets new trajectories. Each trajectory is stored as a .npy file named after the
+# hash of its parameters and read back memory mapped, so that looking up the
+# trajectory of a trial costs an mmap instead of sampling and simulating.
+# All trials of a session can be generated beforehand in worker processes:
+#   python trajectorycache.py experiment.csv --subject 3 --session 1
+
+from __future__ import print_function
+import sys, os, math, hashlib, logging, argparse, multiprocessing, numpy as np
+import physics, root
+
+version = 3 # increase when the motion models change, this invalidates the cache
+
+def seed(subject, session, iCondition, iTrial):
+	"""Seed of the iTrial'th trial of condition iCondition for a subject in a session."""
+	s = "{}/{}/{}/{}".format(subject, session, iCondition, iTrial)
+	return int(hashlib.sha1(s.encode('utf-8')).hexdigest()[:8], 16)
+
+def parameters(settings, trial, seed):
+	"""
+	Parameters that fully determine the trajectory of a trial. settings is
+	a Field (or the Field class), trial a trial dictionary from Conditions.
+	"""
+	return {
+		'version':     version,
+		'moveType':    settings.moveType,
+		'dimType':     settings.dimType,
+		'rBalls':      float(settings.rBalls),
+		'wall':        [[float(x) for x in w] for w in settings.wall],
+		'fFrame':      float(settings.fFrame),
+		'ballCollide': bool(settings.ballCollide),
+		'wallCollide': bool(settings.wallCollide),
+		'nBalls':      int(trial['nBalls']),
+		'sBalls':      float(trial['sBalls']),
+		'lTrial':      float(trial['lTrial']),
+		'seed':        int(seed),
+		}
+
+def key(parameters):
+	return hashlib.sha1(repr(sorted(parameters.items())).encode('utf-8')).hexdigest()
+
+def generate(parameters):
+	"""Simulate the trajectory belonging to parameters, (nFrame, nBalls, nDim) float32."""
+	engine = physics.Engine(parameters['moveType'], parameters['dimType'], parameters['rBalls'],
+		parameters['wall'], parameters['fFrame'], parameters['ballCollide'], parameters['wallCollide'],
+		np.random.RandomState(parameters['seed']))
+	engine.initialize(parameters['nBalls'], parameters['sBalls'])
+	return engine.trajectory(int(math.ceil(parameters['lTrial']*parameters['fFrame'])) + 1)
+
+def save(fileName, positions):
+	"""Save positions via a temporary file, so that readers never see a half written file."""
+	tmpName = "{}.{}.tmp".format(fileName, os.getpid())
+	with open(tmpName, 'wb') as f:
+		np.save(f, positions)
+	try:
+		os.rename(tmpName, fileName)
+	except OSError: # MS Windows, another process was first
+		os.remove(tmpName)
+
+def describe(parameters):
+	"""The parameters that decide whether the balls fit, for error messages."""
+	return "nBalls {}, rBalls {}, wall {}".format(parameters['nBalls'], parameters['rBalls'], parameters['wall'])
+
+def _generateFile(job):
+	"""worker process function, returns the file name and an error message or None"""
+	fileName, parameters = job
+	if not os.path.exists(fileName):
+		try:
+			save(fileName, generate(parameters))
+		except ValueError as e: # balls do not fit between the walls
+			return fileName, str(e)
+	return fileName, None
+
+def sessionParameters(conditions, settings, subject, session):
+	"""
+	Parameters of all trials of a loaded Conditions instance that can be
+	known in advance. Trials with a functor value that depends on the
+	responses of the subject (staircases and such) are left out, these are
+	generated when they are needed.
+	"""
+	parameterList = []
+	for iCondition, condition in enumerate(conditions.conditions):
+		for iTrial in range(condition['iTrial'], condition['nTrial']):
+			trial = dict(condition)
+			if 'functionKey' in condition:
+				function = condition['function']
+				if type(function) not in (root.List, root.Interval):
+					continue
+				trial[condition['functionKey']] = function.x[(function.i + iTrial - condition['iTrial'])%len(function.x)]
+			parameterList.append(parameters(settings, trial, seed(subject, session, iCondition, iTrial)))
+	return parameterList
+
+class TrajectoryCache(object):
+	"""Directory with one memory mappable .npy file per trajectory."""
+	def __init__(self, directory="cache"):
+		self.directory = directory
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	def fileName(self, parameters):
+		return os.path.join(self.directory, key(parameters)+".npy")
+
+	def get(self, parameters):
+		"""Return the trajectory, memory mapped. Generate it first if it is not in the cache."""
+		fileName = self.fileName(parameters)
+		if not os.path.exists(fileName):
+			logging.info("trajectory not in cache, generating {}".format(fileName))
+			fileName, error = _generateFile((fileName, parameters))
+			if error:
+				raise ValueError("{}: {}".format(describe(parameters), error))
+		return np.load(fileName, mmap_mode='r')
+
+	def precompute(self, parameterList, nProcess=None):
+		"""
+		Generate all trajectories in parameterList that are not in the cache
+		yet in nProcess worker processes. Raises ValueError, after logging all
+		trials that failed, if the balls of some trials do not fit.
+		"""
+		jobs = {}
+		for parameters in parameterList:
+			fileName = self.fileName(parameters)
+			if not os.path.exists(fileName):
+				jobs[fileName] = parameters
+		logging.info("precomputing {} of {} trajectories".format(len(jobs), len(parameterList)))
+		if not jobs:
+			return
+		pool = multiprocessing.Pool(nProcess)
+		try:
+			results = pool.map(_generateFile, list(jobs.items()))
+		finally:
+			pool.close()
+			pool.join()
+		errors = [(fileName, error) for fileName, error in results if error]
+		for fileName, error in errors:
+			logging.error("could not generate trajectory with {}: {}".format(describe(jobs[fileName]), error))
+		if errors:
+			raise ValueError("{} of {} trajectories could not be generated, the first with {}".format(
+				len(errors), len(jobs), describe(jobs[errors[0][0]])))
+
+def main():
+	logging.basicConfig(level=logging.INFO)
+	parser = argparse.ArgumentParser(description="Precompute the ball trajectories of all trials in an experiment file.")
+	parser.add_argument("experiment", help="experiment input file (.csv)")
+	parser.add_argument("--subject", help="Subject ID")
+	parser.add_argument("--session", required=True, help="session, the same as given to sledballs.py --session")
+	parser.add_argument("-d", "--directory", default="cache", help="cache directory")
+	parser.add_argument("-j", "--processes", type=int, help="number of worker processes, defaults to the number of CPUs")
+	args = parser.parse_args()
+
+	import conditions, field
+	c = conditions.Conditions()
+	c.load(args.experiment, saveFileName=os.devnull)
+	TrajectoryCache(args.directory).precompute(sessionParameters(c, field.Field, args.subject, args.session), args.processes)
+
+if __name__ == '__main__':
+	main()
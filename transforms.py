@@ -171,3 +171,138 @@ def arjan(width, height, near, focal, far, x, y):
 		], np.float32)
 	return m
 
+
+
+# Batched variants of the builders above, for instance for N viewer positions
+# along a trajectory. Parameters are scalars or arrays that broadcast to shape
+# (N,), points and vectors are (N, 3) or (3,). They return (N, 4, 4) float32
+# ndarrays with the same elements as the scalar builders, so m[i] can be used
+# wherever the matrix of the scalar builder is used.
+
+def _parameters(*args):
+	"""broadcast scalars and arrays to float64 arrays of one shape (N,)"""
+	return np.broadcast_arrays(*[np.atleast_1d(np.asarray(a, dtype=np.float64)) for a in args])
+
+def _matrices(*elements):
+	"""(N, 4, 4) float32 array from 16 elements in row order that broadcast to (N,)"""
+	shape = np.broadcast(*elements).shape
+	m = np.empty(shape+(16,), dtype=np.float32)
+	for i, element in enumerate(elements):
+		m[...,i] = element
+	return m.reshape(shape+(4, 4))
+
+def rotateN(angle, x, y, z):
+	angle, x, y, z = _parameters(angle, x, y, z)
+	c = np.cos(np.radians(angle))
+	s = np.sin(np.radians(angle))
+	length = np.sqrt(x**2 + y**2 + z**2)
+	x, y, z = x/length, y/length, z/length
+	return _matrices(
+		 x**2*(1-c)+c, x*y*(1-c)+z*s, x*z*(1-c)-y*s,    0,
+		y*x*(1-c)-z*s,  y**2*(1-c)+c, y*z*(1-c)+x*s,    0,
+		x*z*(1-c)+y*s, y*z*(1-c)-x*s,  z**2*(1-c)+c,    0,
+		            0,             0,             0,    1)
+
+def translateN(x, y=0, z=0):
+	x, y, z = _parameters(x, y, z)
+	return _matrices(
+		1, 0, 0, 0,
+		0, 1, 0, 0,
+		0, 0, 1, 0,
+		x, y, z, 1)
+
+def lookAtN(eye, center, up):
+	"""lookAtV() for (N, 3) eye, center and up"""
+	eye, center, up = np.broadcast_arrays(*[np.atleast_2d(np.asarray(v, dtype=np.float64)) for v in (eye, center, up)])
+	f = center - eye
+	f = f/np.linalg.norm(f, axis=1)[:,None]
+	up = up/np.linalg.norm(up, axis=1)[:,None]
+	s = np.cross(f, up)
+	u = np.cross(s, f)
+	return _matrices(
+		   s[:,0],    u[:,0],   -f[:,0], 0,
+		   s[:,1],    u[:,1],   -f[:,1], 0,
+		   s[:,2],    u[:,2],   -f[:,2], 0,
+		-eye[:,0], -eye[:,1], -eye[:,2], 1)
+
+def orthoN(left, right, bottom, top, near, far):
+	left, right, bottom, top, near, far = _parameters(left, right, bottom, top, near, far)
+	return _matrices(
+		2./(right-left),               0,              0, 0,
+		              0, 2./(top-bottom),              0, 0,
+		              0,               0, -2./(far-near), 0,
+		  -(right+left),   -(top+bottom),    -(far+near), 1)
+
+def perspectiveN(fovy_deg, aspect, near, far):
+	fovy_deg, aspect, near, far = _parameters(fovy_deg, aspect, near, far)
+	f = 1.0/np.tan(np.radians(fovy_deg)/2.0)
+	return _matrices(
+		f/aspect, 0,                       0,  0,
+		       0, f,                       0,  0,
+		       0, 0,   (far+near)/(near-far), -1,
+		       0, 0, 2.0*far*near/(near-far),  0)
+
+def frustumN(left, right, bottom, top, near, far):
+	left, right, bottom, top, near, far = _parameters(left, right, bottom, top, near, far)
+	return _matrices(
+		2*near/(right-left),                   0,                       0,  0,
+		                  0, 2*near/(top-bottom),                       0,  0,
+		                  0,                   0,   (far+near)/(near-far), -1,
+		                  0,                   0, 2.0*far*near/(near-far),  0)
+
+def arjanN(width, height, near, focal, far, x, y):
+	"""arjan() for N viewer positions x, y (or N of any other parameter)"""
+	width, height, near, focal, far, x, y = _parameters(width, height, near, focal, far, x, y)
+	return _matrices(
+		2*focal/width,              0,                     0,                        0,
+		            0, 2*focal/height,                     0,                        0,
+		   -2*x/width,    -2*y/height, (far+near)/(near-far),                       -1,
+		            0,              0, (2*far*near-focal*(far+near))/(near-far), focal)
+
+def projectN(m, p):
+	"""
+	Normalized device coordinates (..., 3) of points p, (..., 3), transformed
+	by matrices m, (..., 4, 4), as y = x M. Leading dimensions broadcast, so
+	use m[:,None] to project M points for each of N matrices.
+	"""
+	p = np.asarray(p)
+	y = np.einsum('...i,...ij->...j', np.concatenate((p, np.ones(p.shape[:-1]+(1,), p.dtype)), -1), m)
+	return y[...,:3]/y[...,3:]
+
+class StereoProjection(object):
+	"""
+	arjan() matrices of the left and right eye in one preallocated (2, 4, 4)
+	float32 array, mvp, and the eye positions in pEye, (2, 3). update() only
+	writes what changed: all elements if the screen, the planes or the eye
+	distance changed, only the viewer dependent elements if the viewer moved.
+	"""
+	def __init__(self):
+		self.mvp = np.zeros((2, 4, 4), dtype=np.float32)
+		self.pEye = np.zeros((2, 3), dtype=np.float32)
+		self.shape = None
+		self.x = self.y = None
+
+	def update(self, width, height, near, focal, far, x, y, dEyes=0):
+		"""
+		Parameters as in arjan(), x, y is the point between the eyes and
+		dEyes the distance between the eyes, 0 for mono.
+		"""
+		shape = (width, height, near, focal, far, dEyes)
+		if shape != self.shape:
+			self.shape = shape
+			self.mvp[...] = 0
+			self.mvp[:,0,0] = 2*focal/width
+			self.mvp[:,1,1] = 2*focal/height
+			self.mvp[:,2,2] = (far+near)/(near-far)
+			self.mvp[:,2,3] = -1
+			self.mvp[:,3,2] = (2*far*near-focal*(far+near))/(near-far)
+			self.mvp[:,3,3] = focal
+			self.pEye[:,2] = focal
+			self.x = None
+		if x != self.x or y != self.y:
+			self.x, self.y = x, y
+			for iEye, xEye in enumerate((x-dEyes/2, x+dEyes/2)):
+				self.mvp[iEye,2,0] = -2*xEye/width
+				self.pEye[iEye,0] = xEye
+			self.mvp[:,2,1] = -2*y/height
+			self.pEye[:,1] = y